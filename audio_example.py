@@ -3,12 +3,13 @@ import pandas
 import gcp_functions.stateBag as sb
 import gcp_functions.storage as StorageHelper
 from gcp_functions.config import ProjectConfig, AudioConfig
-from gcp_functions.gemini import gemini_audio_response
+from gcp_functions.gemini import gemini_audio_response_async
+from gcp_functions.warmup import start_warm_up, STORAGE_GEMINI_STEPS
 
 
-def handle_audio_finish(audio_filepath: str, state: gr.State):
+async def handle_audio_finish(audio_filepath: str, state: gr.State):
     upload_bucket = AudioConfig.upload_bucket()
-    f, gcs = StorageHelper.file_upload(audio_filepath, upload_bucket)
+    f, gcs = await StorageHelper.file_upload_async(audio_filepath, upload_bucket)
     
     audio_file_uri = gcs
 
@@ -16,7 +17,7 @@ def handle_audio_finish(audio_filepath: str, state: gr.State):
     You are a native Spanish speaker. Evaluate and provide feedback in English on the grammar and pronunciation. 
     Ignore pronunciation of names."""
     
-    response = gemini_audio_response(audio_file_uri, prompt)
+    response = await gemini_audio_response_async(audio_file_uri, prompt)
 
     return response
 
@@ -40,7 +41,7 @@ def main():
     """
     # UI Layout
     with gr.Blocks() as demo:
-        bag = sb.StateBag(project_id=ProjectConfig.get_project_id())
+        bag = sb.StateBag()
 
         # create the session state to be used within this Block()
         state = gr.State(bag)
@@ -52,7 +53,11 @@ def main():
         with gr.Row():
             audio_input(handle_audio_finish, state)
 
-    demo.launch(share=False, debug=True, allowed_paths=["images"])
+    # start serving first, then create the clients in the background
+    demo.launch(share=False, prevent_thread_lock=True, allowed_paths=["images"])
+    # only the clients this app uses
+    start_warm_up(STORAGE_GEMINI_STEPS)
+    demo.block_thread()
 
 
 
@@ -0,0 +1,119 @@
+"""
+Benchmark peak memory of parsing a docAI output shard
+
+Generates a synthetic docAI output json (text, entities and full page
+layouts with tokens and bounding boxes) and parses it in a fresh process
+per mode, reporting wall time and peak RSS:
+
+    json    json.loads() of the whole shard (the original behaviour)
+    fast    docai_json.loads() of the whole shard (orjson when installed)
+    stream  docai_json.load_stream() with the summary parser field mask
+
+Usage:
+    python benchmarks/bench_docai_parse.py [--pages 300]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+FIELD_MASK = "text,entities,pages.pageNumber"
+MODES = ["json", "fast", "stream"]
+
+
+def make_shard(path: str, pages: int, tokens_per_page: int = 400):
+    """
+    Write a synthetic docAI output json with the given number of pages
+    """
+    word = "lorem"
+    text = " ".join([word] * tokens_per_page * pages)
+
+    def layout(start):
+        return {
+            "textAnchor": {"textSegments": [{"startIndex": str(start), "endIndex": str(start + 5)}]},
+            "confidence": 0.98,
+            "boundingPoly": {"normalizedVertices": [{"x": 0.1, "y": 0.1}, {"x": 0.2, "y": 0.1},
+                                                    {"x": 0.2, "y": 0.2}, {"x": 0.1, "y": 0.2}]},
+            "orientation": "PAGE_UP",
+        }
+
+    doc = {
+        "uri": "",
+        "mimeType": "application/pdf",
+        "text": text,
+        "entities": [{"type": "summary", "mentionText": "summary",
+                      "normalizedValue": {"text": "a synthetic summary"}}],
+        "pages": [
+            {
+                "pageNumber": p + 1,
+                "dimension": {"width": 1700, "height": 2200, "unit": "pixels"},
+                "layout": layout(0),
+                "tokens": [{"layout": layout(i * 6), "detectedBreak": {"type": "SPACE"}}
+                           for i in range(tokens_per_page)],
+            }
+            for p in range(pages)
+        ],
+    }
+
+    with open(path, "w") as f:
+        json.dump(doc, f)
+
+
+def run_mode(mode: str, path: str):
+    """
+    Parse the shard with one mode; runs inside the child process
+    """
+    from gcp_functions import docai_json
+
+    start = time.perf_counter()
+    if mode == "json":
+        with open(path, "rb") as f:
+            doc = json.loads(f.read())
+    elif mode == "fast":
+        with open(path, "rb") as f:
+            doc = docai_json.loads(f.read())
+    else:
+        with open(path, "rb") as f:
+            doc = docai_json.load_stream(f, FIELD_MASK)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode:>6}: {elapsed:7.2f}s  peak RSS {peak_mb:8.1f} MB  ({len(doc['text'])} chars)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--file", help=argparse.SUPPRESS)
+    parser.add_argument("--make", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.make:
+        make_shard(args.file, args.pages)
+        return
+
+    if args.mode:
+        run_mode(args.mode, args.file)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "shard-0.json")
+        # every step runs in its own process; linux carries ru_maxrss over
+        # fork+exec, so a large parent would inflate the children's numbers
+        subprocess.run([sys.executable, __file__, "--make", "--pages", str(args.pages), "--file", path], check=True)
+        print(f"{args.pages} page shard: {os.path.getsize(path) / 1024 / 1024:.1f} MB on disk")
+
+        for mode in MODES:
+            subprocess.run([sys.executable, __file__, "--mode", mode, "--file", path], check=True)
+
+
+if __name__ == "__main__":
+    main()
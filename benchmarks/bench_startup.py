@@ -0,0 +1,117 @@
+"""
+Benchmark cold start of the document QA app
+
+For each mode, in a fresh process per run, measures:
+
+    import   time to import document_qa
+    serve    time from process start until the UI answers its first http request
+    warm     time from process start until the background warm-up is done
+
+Modes:
+
+    lazy     GCP sdks imported on first use (the current behaviour)
+    eager    GCP sdks imported before the app, as they were at module load
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 3] [--modes lazy eager]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+EAGER_IMPORTS = ("import google.cloud.storage, google.cloud.documentai, google.cloud.discoveryengine_v1, "
+                 "vertexai.generative_models, vertexai.preview.caching; ")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_import(mode: str):
+    """
+    Seconds to import document_qa in a fresh process
+    """
+    code = ("import time; start = time.perf_counter(); "
+            + (EAGER_IMPORTS if mode == "eager" else "")
+            + "import document_qa; print(time.perf_counter() - start)")
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def time_serve(mode: str, timeout: float = 120):
+    """
+    Seconds until the app answers its first request, and until its warm-up is done
+    """
+    port = free_port()
+    env = dict(os.environ, GRADIO_SERVER_PORT=str(port), GRADIO_ANALYTICS_ENABLED="False", PYTHONUNBUFFERED="1")
+    code = ((EAGER_IMPORTS if mode == "eager" else "")
+            + "import runpy; runpy.run_path('document_qa.py', run_name='__main__')")
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    # watch the app's output for the end of the warm-up
+    warmed = threading.Event()
+    warm = [None]
+
+    def watch():
+        for line in process.stdout:
+            if line.startswith("Warm-up done") and not warmed.is_set():
+                warm[0] = time.perf_counter() - start
+                warmed.set()
+
+    threading.Thread(target=watch, daemon=True).start()
+
+    serve = None
+    try:
+        while serve is None and time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"app exited with {process.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        serve = time.perf_counter() - start
+            except OSError:
+                time.sleep(0.05)
+        warmed.wait(max(0, timeout - (time.perf_counter() - start)))
+    finally:
+        process.kill()
+        process.wait()
+
+    return serve, warm[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="runs per mode; the median is reported")
+    parser.add_argument("--modes", nargs="+", default=["lazy", "eager"], choices=["lazy", "eager"])
+    args = parser.parse_args()
+
+    def median(values):
+        values = [v for v in values if v is not None]
+        return f"{statistics.median(values):8.2f}s" if values else "     n/a"
+
+    print(f"{'mode':<8}{'import':>10}{'serve':>10}{'warm':>10}")
+    for mode in args.modes:
+        imports, serves, warms = [], [], []
+        for _ in range(args.runs):
+            imports.append(time_import(mode))
+            serve, warm = time_serve(mode)
+            serves.append(serve)
+            warms.append(warm)
+        print(f"{mode:<8}{median(imports):>10}{median(serves):>10}{median(warms):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import gradio as gr
+from gcp_functions.session_store import session_handler
 from typing import Callable
 
 def contract_component(handle_func: Callable, state: gr.State):
@@ -7,8 +8,9 @@ def contract_component(handle_func: Callable, state: gr.State):
 
     Args:
         handle_func (Callable): function to handle the file upload event
-            - must take 2 params (file_url: str, state: gradio.State)
+            - must take 2 params (file_urls: list, state: gradio.State)
             - must return 3 items (gcs_input_uri: str, df_entities: Dataframe, state: gradio.State)
+            - may be a (async) generator that yields progress into gcs_input_uri before the final 3 items
         state (gradio.State): session state object of type gcp_functions.StateBag
 
     Returns:
@@ -22,7 +24,7 @@ def contract_component(handle_func: Callable, state: gr.State):
             upload_btn = gr.UploadButton(
                 "Click to upload",
                 file_types=[".pdf"],
-                file_count="single")
+                file_count="multiple")
         with gr.Row():
             entities = gr.DataFrame(headers=['type', 'mentionText'], 
                                     column_widths=['200px'],
@@ -33,6 +35,7 @@ def contract_component(handle_func: Callable, state: gr.State):
     upload_btn.upload(handle_func,[upload_btn, state],[file, entities, state])
 
     # local function to handle when the summary tab is selected
+    @session_handler
     def set_active_tab(state: gr.State):
         state.active_tab = "contract"
         return state
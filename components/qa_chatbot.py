@@ -9,6 +9,7 @@ def qa_component(handle_func: Callable, state: gr.State):
         handle_func (Callable): function to handle the textbox submit event
             - must take 3 params (message: str, history: str, state: gradio.State)
             - must return 2 items ("": str, history: str)
+            - may be a generator that yields the 2 items repeatedly to stream the answer
         state (gradio.State): session state object
 
     Returns:
@@ -1,4 +1,5 @@
 import gradio as gr
+from gcp_functions.session_store import session_handler
 
 def search_component(init_engine_id: str, state: gr.State):
     """
@@ -16,6 +17,7 @@ def search_component(init_engine_id: str, state: gr.State):
             search_engine = gr.Textbox(lines=1, label="Search Engine Id", value=init_engine_id)
 
     # local function to handle search engine id change to update session state
+    @session_handler
     def handle_search_engine_change(engine_id: str, state: gr.State):
         state.engine_id = engine_id
         return state
@@ -24,6 +26,7 @@ def search_component(init_engine_id: str, state: gr.State):
     search_engine.change(handle_search_engine_change, [search_engine, state], [state])
 
     # local function to handle tab "select" event to update session state and engine id
+    @session_handler
     def set_active_tab(engine_id: str, state: gr.State):
         state.active_tab = "kb"
         state.engine_id = engine_id
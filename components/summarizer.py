@@ -1,4 +1,5 @@
 import gradio as gr
+from gcp_functions.session_store import session_handler
 from typing import Callable
 
 def summary_component(handle_func: Callable, state: gr.State):
@@ -7,8 +8,9 @@ def summary_component(handle_func: Callable, state: gr.State):
 
     Args:
         handle_func (Callable): function to handle the file upload event
-            - must take 2 params (file_url: str, state: Gradio.State)
+            - must take 2 params (file_urls: list, state: Gradio.State)
             - must return 3 items (file_url: str, summary: str, state: Gradio.State)
+            - may be a (async) generator that yields progress into file_url before the final 3 items
         state (gradio.State): session state object of type gcp_functions.StateBag
 
     Returns:
@@ -22,7 +24,7 @@ def summary_component(handle_func: Callable, state: gr.State):
             upload_btn = gr.UploadButton(
                 "Click to upload",
                 file_types=[".pdf"],
-                file_count="single")
+                file_count="multiple")
         with gr.Row():
             summary = gr.Textbox(lines=20, label="Summary")
 
@@ -30,6 +32,7 @@ def summary_component(handle_func: Callable, state: gr.State):
     upload_btn.upload(handle_func, [upload_btn, state], [file, summary, state])
 
     # local function to handle when the summary tab is selected
+    @session_handler
     def set_active_tab(state: gr.State):
         state.active_tab = "summary"
         return state
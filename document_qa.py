@@ -1,12 +1,16 @@
 import gradio as gr
 import pandas
 
-import gcp_functions.storage as StorageHelper
 import gcp_functions.stateBag as sb
-from gcp_functions.docai import process_document
-from gcp_functions.config import SummaryParserConfig, ContractParserConfig, ProjectConfig, DiscoveryEngineConfig
-from gcp_functions.gemini import gemini_docqa_response
-from gcp_functions.discoveryengine import search
+from gcp_functions.config import SummaryParserConfig, ContractParserConfig, ProjectConfig, DiscoveryEngineConfig, GeminiConfig
+from gcp_functions.gemini import gemini_docqa_response_stream_async
+from gcp_functions.retrieval import build_index
+from gcp_functions.context_cache import get_context_cache
+from gcp_functions.discoveryengine import search_async
+from gcp_functions.pipeline import get_pipeline
+from gcp_functions.credentials import get_service_account_credentials
+from gcp_functions.warmup import start_warm_up
+from gcp_functions.session_store import session_handler, get_session_store
 
 from components.contract_parser import contract_component
 from components.qa_chatbot import qa_component
@@ -14,143 +18,222 @@ from components.search import search_component
 from components.summarizer import summary_component
 
 from google.oauth2.service_account import Credentials
-import json
+import asyncio
 from urllib.parse import urlparse
-
-# only needed for edge case: contract parser in another GCP project
-from dotenv import load_dotenv
 import os
 
-def handle_summary_upload(file_url: str, state: gr.State):
+async def process_uploads(file_urls: list,
+                          parser_config,
+                          project_id: str,
+                          state: sb.StateBag,
+                          credentials: Credentials | None = None):
+    """
+    Submit uploaded files to the document pipeline (see gcp_functions.pipeline)
+    and follow the job until it is done. The pipeline picks the cheapest path
+    for each file:
+        - files already processed are read from the document cache
+        - files being processed for another session wait for its result
+        - small files are processed online, skipping the bucket entirely
+        - large pdfs can be split into page ranges processed concurrently
+        - everything else is uploaded concurrently and submitted as a
+          single batch request
+
+    The job id is kept in the session state, so the job keeps running (and
+    can be looked up again) if this handler goes away
+
+    Args:
+        file_urls (list): local file locations to be processed
+        parser_config: parser config class (SummaryParserConfig or ContractParserConfig)
+        project_id (str): project id where the processor is created
+        state (StateBag): session state the job id is stored in
+        credentials (Credentials): Optional. credentials to run as
+
+    Yields:
+        (progress, None) while processing, then finally (None, results) where
+        results is a list of dicts with gcs_input_uri, summary, entities and text
+        for each file, in the order of file_urls
+    """
+    pipeline = get_pipeline()
+    # followed through a local; other events of the session may restore the
+    # state from the session store while the job runs
+    job_id = state.job_id = await pipeline.submit(file_urls, parser_config, project_id, credentials)
+
+    while True:
+        status = await pipeline.wait(job_id, timeout=5)
+        if status["state"] == "failed":
+            raise status["error"]
+        if status["state"] == "done":
+            break
+        yield status["progress"], None
+
+    yield None, status["results"]
+
+
+def set_document(state: gr.State, text: str):
+    """
+    Set the session's current document, letting go of the previous one's
+    cached context (see gcp_functions.context_cache). Cached contexts are
+    counted per process, so only the one this process acquired is released
+    """
+    context_cache = get_context_cache()
+
+    if state.cached_context is not None:
+        context_cache.release(*state.cached_context)
+    state.ocr_text = text
+    state.cached_context = (state.ocr_handle, GeminiConfig.model()) if state.ocr_handle else None
+    if state.cached_context is not None:
+        context_cache.acquire(*state.cached_context)
+
+
+def handle_session_end(state: sb.StateBag):
+    """
+    Called by Gradio when a session's state is deleted; lets go of the
+    session's document so its cached context and stored text can be cleaned up,
+    and deletes the session from the session store if there is one
+    """
+    if state.cached_context is not None:
+        # only if acquired here; the session may have been served by another process
+        get_context_cache().release(*state.cached_context)
+        state.cached_context = None
+    store = get_session_store()
+    if store is not None and state.session_id:
+        store.delete(state.session_id)
+    state.close()
+
+
+def _as_list(file_urls: list | str):
+    # the upload button passes a single path or a list depending on file_count
+    return [file_urls] if isinstance(file_urls, str) else list(file_urls)
+
+
+def _join_text(file_urls: list, results: list):
+    # keep track of which file the ocr text came from when several are uploaded
+    if len(results) == 1:
+        return results[0]["text"]
+    return "\n".join(f"Document: {os.path.basename(f)}\n{r['text']}" for f, r in zip(file_urls, results))
+
+
+@session_handler
+async def handle_summary_upload(file_urls: list | str, state: gr.State):
     """
-    Handler function for uploading a file for doc summarization
+    Handler function for uploading one or more files for doc summarization
+
+    Will take local files and upload them to a Cloud Storage bucket and then
+    use DocAI processor to make a single batch request (to handle larger files)
+    and then parse out the Summary and OCR Text from the json results.
+    Small files are processed online instead, skipping the bucket entirely,
+    and large pdfs can be split into page ranges processed concurrently
 
-    Will take a local file and upload to a Cloud Storage bucket and then
-    use DocAI processor to make a batch request (to handle larger files)
-    and then parse out the Summary and OCR Text from the json results
+    This is an async generator: it yields progress (uploading, processing,
+    parsing) in the file textbox while the work runs
 
     Args:
-        file_url (str): local file location to be uploaded
+        file_urls (list): local file locations to be uploaded (or a single location)
         state (gradio.State): session state object of type gcp_functions.stateBag
 
-    Returns: 
-        gcs_uri (str): cloud storage bucket URI of the input file
+    Yields: 
+        gcs_uri (str): progress, then the cloud storage bucket URIs of the input files (local path if processed online)
         summary (str): summary from parser result
         state (gradio.State): updated session state
     """
-    upload_bucket = SummaryParserConfig.upload_bucket()
-    
-    # upload the file from the local dir to the cloud bucket
-    f, gcs = StorageHelper.file_upload(file_url, upload_bucket)
-    
-    project_id = ProjectConfig.get_project_id()
-    location = SummaryParserConfig.location()
-    processor_id = SummaryParserConfig.processor_id()
-    mime_type = SummaryParserConfig.mime_type()
-    field_mask = SummaryParserConfig.field_mask()
-    gcs_input_uri = gcs
-    gcs_output_uri = f"gs://{SummaryParserConfig.output_bucket()}"
-
-    # make a request for processing the uploaded file
-    metadata = process_document(
-        project_id=project_id, 
-        location=location, 
-        processor_id=processor_id, 
-        mime_type=mime_type, 
-        field_mask=field_mask, 
-        gcs_input_uri=gcs_input_uri, 
-        gcs_output_uri=gcs_output_uri
-    )
-
-    # assumes result json is from a DocAI Workbench Summarizer parser
-    output_gcs_destination = metadata.individual_process_statuses[0].output_gcs_destination
-    json_uri, summary, text = StorageHelper.extract_from_summary_output(output_gcs_destination)
+    file_urls = _as_list(file_urls)
+    # the first lookup may ask the metadata server; keep it off the event loop
+    project_id = await asyncio.to_thread(ProjectConfig.get_project_id)
+
+    async for progress, results in process_uploads(file_urls, SummaryParserConfig, project_id, state):
+        if results is None:
+            yield progress, gr.update(), state
+
+    # show each file's summary under its name when several are uploaded
+    if len(results) == 1:
+        summary = results[0]["summary"]
+    else:
+        summary = "\n".join(f"{os.path.basename(f)}:\n{r['summary']}" for f, r in zip(file_urls, results))
 
     # set the current full ocr text in session state; we use this for 
     # QnA prompting to provide context for the prompts
-    state.ocr_text = text
+    set_document(state, _join_text(file_urls, results))
+
+    # index large documents now rather than on the first question
+    await asyncio.to_thread(build_index, state.ocr_text)
     
-    # returns the result location, the summary portion, and the session state
-    return gcs_input_uri, summary, state
+    # returns the result locations, the summary portion, and the session state
+    yield "\n".join(r["gcs_input_uri"] for r in results), summary, state
     
 
-def handle_contract_upload(file_url: str, state: gr.State):
+@session_handler
+async def handle_contract_upload(file_urls: list | str, state: gr.State):
     """
-    Handler function for uploading a file for doc contract parser
+    Handler function for uploading one or more files for doc contract parser
 
-    Will take a local file and upload to a Cloud Storage bucket and then
-    use DocAI processor to make a batch request (to handle larger files)
-    and then parse out the Entities and OCR Text from the json results
+    Will take local files and upload them to a Cloud Storage bucket and then
+    use DocAI processor to make a single batch request (to handle larger files)
+    and then parse out the Entities and OCR Text from the json results.
+    Small files are processed online instead, skipping the bucket entirely,
+    and large pdfs can be split into page ranges processed concurrently
+
+    This is an async generator: it yields progress (uploading, processing,
+    parsing) in the file textbox while the work runs
 
     NOTE: this parser is in another GCP project so it uses service account
     to access the parser as well as to access GCS buckets
 
     Args:
-        file_url (str): local file location to be uploaded
+        file_urls (list): local file locations to be uploaded (or a single location)
         state (gradio.State): session state object of type gcp_functions.stateBag
 
-    Returns: 
-        gcs_uri (str): cloud storage bucket URI of the input file
+    Yields: 
+        gcs_uri (str): progress, then the cloud storage bucket URIs of the input files (local path if processed online)
         df_entities (Dataframe): dataframe of the parsed out contract entities
         state (gradio.State): updated session state
     """
-    # load environment vars; only necessary for cross project access
-    load_dotenv()
-
-    upload_bucket = ContractParserConfig.upload_bucket()
+    file_urls = _as_list(file_urls)
 
-    # create credentials from service account because 
-    # Contract Parser is in another project in another tenant
-    service_account_info = json.load(open(os.environ.get('CONTRACT_PROJECT_SA_KEY'))) 
-    credentials = Credentials.from_service_account_info(service_account_info)    
+    # use the service account's credentials because Contract Parser is in
+    # another project in another tenant; the key is only loaded once and
+    # the token is refreshed in the background
+    credentials = get_service_account_credentials(ContractParserConfig.service_account_key())
     
-    # upload the file from the local dir to the cloud bucket
-    f, gcs = StorageHelper.file_upload(file_url, upload_bucket, credentials)
-    
-    project_id = os.environ.get('CONTRACT_PROJECT_ID')
-    location = ContractParserConfig.location()
-    processor_id = ContractParserConfig.processor_id()
-    mime_type = ContractParserConfig.mime_type()
-    field_mask = ContractParserConfig.field_mask()
-    gcs_input_uri = gcs
-    gcs_output_uri = f"gs://{ContractParserConfig.output_bucket()}"    
-
-    # make a request for processing the uploaded file
-    metadata = process_document(
-        project_id=project_id, 
-        location=location, 
-        processor_id=processor_id, 
-        mime_type=mime_type, 
-        field_mask=field_mask, 
-        gcs_input_uri=gcs_input_uri, 
-        gcs_output_uri=gcs_output_uri,
-        credentials=credentials
-    )
-    
-    # assumes result json is from a DocAI Contract parser
-    output_gcs_destination = metadata.individual_process_statuses[0].output_gcs_destination
-    json_uri, entities, text = StorageHelper.extract_from_contract_output(output_gcs_destination, credentials)
-    
-    # convert to dataframe
-    df_entities = pandas.DataFrame(entities)
+    project_id = ContractParserConfig.project_id()
 
-    # store the full ocr text from the document in session state
-    state.ocr_text = text
+    async for progress, results in process_uploads(file_urls, ContractParserConfig, project_id, state, credentials):
+        if results is None:
+            yield progress, gr.update(), state
+
+    # convert to dataframe; add the file name column when several are uploaded
+    if len(results) == 1:
+        df_entities = pandas.DataFrame(results[0]["entities"])
+    else:
+        df_entities = pandas.DataFrame([{**entity, 'file': os.path.basename(f)}
+                                        for f, r in zip(file_urls, results)
+                                        for entity in r["entities"]])
+
+    # store the full ocr text from the documents in session state
+    set_document(state, _join_text(file_urls, results))
+
+    # index large documents now rather than on the first question
+    await asyncio.to_thread(build_index, state.ocr_text)
     
-    # returns the result location, the extracted entities, and updated session state
-    return gcs_input_uri, df_entities, state     
+    # returns the result locations, the extracted entities, and updated session state
+    yield "\n".join(r["gcs_input_uri"] for r in results), df_entities, state     
     
 
-def handle_qa_submit(message: str, history: str, state: gr.State):
+@session_handler
+async def handle_qa_submit(message: str, history: str, state: gr.State):
     """
     Handler function for handling a response to a user input in the chatbot
 
+    This is an async generator: document QA answers are streamed into the
+    chat as the model generates them, so the user sees the first words of
+    the answer without waiting for the full response, and no worker thread
+    is held while waiting on the backends
+
     Args:
         message (str): the submitted message by the user
-        history (str): retained history of the entire chat conversation. Not currently used
+        history (str): retained history of the entire chat conversation; recent turns go into the prompt
         state (gradio.State): session state object of type gcp_function.stateBag
 
-    Returns: 
+    Yields: 
         message in user input box
         history of entire chat conversation
     
@@ -159,23 +242,28 @@ def handle_qa_submit(message: str, history: str, state: gr.State):
     
     # if active tab is on "Enterprise KB", use search function
     if (state.active_tab == "kb"):
-        project_id = state.project_id
+        project_id = state.project_id or await asyncio.to_thread(ProjectConfig.get_project_id)
         engine_id = state.engine_id
 
         # set the preamble context for the search engine
         context = """You are a search engine answering questions for a user. 
         Return pertinent snippets from the source documents where you answer from."""
 
-        resp, raw = search(project_id, engine_id, context, message)
-    # otherwise use the gemini docqa response function
+        resp, raw = await search_async(project_id, engine_id, context, message)
+
+        # capture chat history
+        history.append((message, resp))
+        yield "", history
+    # otherwise stream the gemini docqa response
     else:
         ocr_text = state.ocr_text
-        resp = gemini_docqa_response(message, history, ocr_text)
-        
-    # capture chat history
-    history.append((message, resp))
 
-    return "", history
+        # capture chat history; the answer is filled in as it streams
+        history.append((message, resp))
+        async for chunk in gemini_docqa_response_stream_async(message, history[:-1], ocr_text):
+            resp = f"{resp}{chunk}"
+            history[-1] = (message, resp)
+            yield "", history
 
 
 def main():
@@ -186,13 +274,14 @@ def main():
     """
     # UI Layout
     with gr.Blocks() as demo:
+        # the project id is looked up on first use (or by the warm-up) rather
+        # than holding up the UI on the metadata server
         bag = sb.StateBag(active_tab="summary", 
                         ocr_text="none", 
-                        engine_id=DiscoveryEngineConfig.engine_id(), 
-                        project_id=ProjectConfig.get_project_id())
+                        engine_id=DiscoveryEngineConfig.engine_id())
 
         # create the session state to be used within this Block()
-        state = gr.State(bag)
+        state = gr.State(bag, delete_callback=handle_session_end)
 
         # logo on top of the page
         with gr.Row():
@@ -223,9 +312,15 @@ def main():
         btn.click(handle, [state], [msg])
         '''
 
-    demo.launch(share=False, debug=True, allowed_paths=["images"])
+    # start serving first, then create the clients and credentials in the
+    # background; block_thread keeps the process up like debug=True did
+    demo.launch(share=False, prevent_thread_lock=True, allowed_paths=["images"])
+    start_warm_up()
+    demo.block_thread()
 
 
 
-# run the main routine
-main()
+# run the main routine; guarded so that the pipeline's parse processes
+# (which re-import this module) don't start the UI
+if __name__ == "__main__":
+    main()
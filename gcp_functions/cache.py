@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Optional
+from .config import DocumentCacheConfig, AnswerCacheConfig
+
+
+class DiskCache:
+    """
+    Persistent key/value cache backed by a local sqlite file. Values are
+    json serialised and compressed; when the total size goes over max_bytes
+    the least recently used entries are evicted
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._conn.commit()
+
+    def get(self, key: str):
+        """
+        Returns the cached value for key, or None on a miss
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: str, value):
+        """
+        Store a json serialisable value under key and evict least recently
+        used entries until the cache fits in max_bytes
+        """
+        blob = zlib.compress(json.dumps(value).encode("utf-8"))
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def _evict(self):
+        # caller holds the lock
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            print(f"Evicted {key} from cache {self.path}")
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory LRU cache whose entries expire after ttl seconds.
+    Keeps hit/miss counters, and can write through to a DiskCache so that
+    entries survive a restart
+
+    Args:
+        max_entries: max number of entries kept in memory
+        ttl: seconds an entry is valid for
+        disk: Optional. DiskCache to persist entries to
+    """
+    def __init__(self, max_entries: int, ttl: float, disk: Optional[DiskCache] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """
+        Returns the cached value for key, or None on a miss
+        """
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        if self.disk is not None:
+            stored = self.disk.get(key)
+            if stored is not None and stored["expires"] > now:
+                with self._lock:
+                    self._set(key, stored["value"], stored["expires"])
+                    self.hits += 1
+                return stored["value"]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value):
+        expires = time.time() + self.ttl
+
+        with self._lock:
+            self._set(key, value, expires)
+
+        if self.disk is not None:
+            self.disk.put(key, {"value": value, "expires": expires})
+
+    def _set(self, key: str, value, expires: float):
+        # caller holds the lock
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Hit/miss counters and current size
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0,
+                    "size": len(self._entries)}
+
+
+def normalize_query(text: str):
+    """
+    Question or query text as used in cache keys: case, whitespace and
+    trailing punctuation don't change the answer
+    """
+    return re.sub(r"\s+", " ", text).strip().lower().rstrip("?!. ")
+
+
+def file_hash(file_url: str):
+    """
+    sha256 of a local file's content
+    """
+    digest = hashlib.sha256()
+    with open(file_url, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def document_key(content_hash: str,
+                 project_id: str,
+                 location: str,
+                 processor_id: str,
+                 processor_version_id: Optional[str] = None,
+                 field_mask: Optional[str] = None):
+    """
+    Cache key of a processed document. The same file run through another
+    processor, processor version or field mask is a different entry, as is
+    the same processor id in another project or location
+    """
+    return (f"{content_hash}:{project_id}:{location}:{processor_id}:"
+            f"{processor_version_id or ''}:{field_mask or ''}")
+
+
+_document_cache = None
+_document_cache_lock = threading.Lock()
+
+
+def get_document_cache():
+    """
+    Process-wide cache of processed documents, or None if it is disabled
+    (see DocumentCacheConfig)
+    """
+    global _document_cache
+
+    if not DocumentCacheConfig.enabled():
+        return None
+
+    with _document_cache_lock:
+        if _document_cache is None:
+            _document_cache = DiskCache(DocumentCacheConfig.path(),
+                                        DocumentCacheConfig.max_mb() * 1024 * 1024)
+
+    return _document_cache
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """
+    Process-wide cache of document QA answers, or None if it is disabled
+    (see AnswerCacheConfig)
+    """
+    global _answer_cache
+
+    if not AnswerCacheConfig.enabled():
+        return None
+
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            disk = None
+            if AnswerCacheConfig.path():
+                disk = DiskCache(AnswerCacheConfig.path(), AnswerCacheConfig.max_mb() * 1024 * 1024)
+            _answer_cache = TTLCache(AnswerCacheConfig.max_entries(), AnswerCacheConfig.ttl_seconds(), disk)
+
+    return _answer_cache
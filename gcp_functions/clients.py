@@ -0,0 +1,241 @@
+import asyncio
+import atexit
+import threading
+from typing import Callable, Optional
+import google.auth
+from google.auth.credentials import with_scopes_if_required
+from google.auth.transport.requests import AuthorizedSession
+from google.api_core.client_options import ClientOptions
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from .config import ClientConfig
+from .lazy import lazy_import
+
+# the sdks are imported when the first client is created (see gcp_functions.lazy)
+storage = lazy_import("google.cloud.storage")
+docai = lazy_import("google.cloud.documentai")
+discoveryengine = lazy_import("google.cloud.discoveryengine_v1")
+generative_models = lazy_import("vertexai.generative_models")
+
+# process-wide registry of shared clients, keyed by
+# (service, endpoint/location, credentials identity[, event loop])
+_clients = {}
+_lock = threading.Lock()
+
+
+def credentials_key(credentials: Optional[Credentials]):
+    """
+    Identity of a set of credentials, for use in registry or request keys.
+    Service account credentials are keyed by their email so that separately
+    loaded copies of the same key share a client
+    """
+    if credentials is None:
+        return "default"
+
+    email = getattr(credentials, "service_account_email", None)
+    if email:
+        return email
+
+    return f"id:{id(credentials)}"
+
+
+def _get_or_create(key: tuple, factory: Callable):
+    """
+    Return the client registered under key, lazily creating it with factory
+    """
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        # another thread may have created it while we waited on the lock
+        client = _clients.get(key)
+        if client is None:
+            print(f"Creating shared client for {key[0]} ({key[1]})")
+            client = factory()
+            _clients[key] = client
+
+    return client
+
+
+def get_storage_client(credentials: Optional[Credentials] = None):
+    """
+    Shared Cloud Storage client. The underlying http session is given a
+    bounded connection pool (see ClientConfig.pool_size) so concurrent
+    uploads and downloads reuse warm connections
+
+    Args:
+        credentials: Optional. set to run as a specific user
+
+    Returns:
+        storage.Client
+    """
+    def factory():
+        creds = credentials
+        if creds is None:
+            creds, _ = google.auth.default(scopes=storage.Client.SCOPE)
+        creds = with_scopes_if_required(creds, storage.Client.SCOPE)
+
+        pool_size = ClientConfig.pool_size()
+        session = AuthorizedSession(creds)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+
+        return storage.Client(credentials=creds, _http=session)
+
+    key = ("storage", "global", credentials_key(credentials))
+    return _get_or_create(key, factory)
+
+
+def get_docai_client(location: str, credentials: Optional[Credentials] = None):
+    """
+    Shared Document AI processor client for a location. gRPC channels
+    multiplex concurrent requests so a single client per location is enough
+
+    Args:
+        location: location of the processor (us, eu, etc)
+        credentials: Optional. set to run as a specific user
+
+    Returns:
+        DocumentProcessorServiceClient
+    """
+    def factory():
+        # You must set the `api_endpoint` if you use a location other than "us".
+        opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+
+        # if no credentials, will use the default application credentials
+        if credentials is not None:
+            return docai.DocumentProcessorServiceClient(client_options=opts, credentials=credentials)
+        return docai.DocumentProcessorServiceClient(client_options=opts)
+
+    key = ("documentai", location, credentials_key(credentials))
+    return _get_or_create(key, factory)
+
+
+def get_search_client(location: str):
+    """
+    Shared Discovery Engine search client for a location
+
+    Args:
+        location: location of the search engine (us, global, etc)
+
+    Returns:
+        SearchServiceClient
+    """
+    def factory():
+        client_options = (
+            ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com")
+            if location != "global"
+            else None
+        )
+        return discoveryengine.SearchServiceClient(client_options=client_options)
+
+    key = ("discoveryengine", location, credentials_key(None))
+    return _get_or_create(key, factory)
+
+
+def _loop_key():
+    # async grpc channels belong to the event loop they were created on
+    return f"loop:{id(asyncio.get_running_loop())}"
+
+
+def get_docai_async_client(location: str, credentials: Optional[Credentials] = None):
+    """
+    Shared async Document AI processor client for a location, on the
+    running event loop. Must be called from a coroutine
+
+    Args:
+        location: location of the processor (us, eu, etc)
+        credentials: Optional. set to run as a specific user
+
+    Returns:
+        DocumentProcessorServiceAsyncClient
+    """
+    def factory():
+        opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+        if credentials is not None:
+            return docai.DocumentProcessorServiceAsyncClient(client_options=opts, credentials=credentials)
+        return docai.DocumentProcessorServiceAsyncClient(client_options=opts)
+
+    key = ("documentai_async", location, credentials_key(credentials), _loop_key())
+    return _get_or_create(key, factory)
+
+
+def get_search_async_client(location: str):
+    """
+    Shared async Discovery Engine search client for a location, on the
+    running event loop. Must be called from a coroutine
+
+    Args:
+        location: location of the search engine (us, global, etc)
+
+    Returns:
+        SearchServiceAsyncClient
+    """
+    def factory():
+        client_options = (
+            ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com")
+            if location != "global"
+            else None
+        )
+        return discoveryengine.SearchServiceAsyncClient(client_options=client_options)
+
+    key = ("discoveryengine_async", location, credentials_key(None), _loop_key())
+    return _get_or_create(key, factory)
+
+
+def get_async_generative_model(model_name: str):
+    """
+    Shared Gemini model for the async api (generate_content_async) on the
+    running event loop; the model binds its async client to the loop on
+    first use. Must be called from a coroutine
+
+    Args:
+        model_name: name of the model (gemini-1.5-flash-001, etc)
+
+    Returns:
+        GenerativeModel
+    """
+    key = ("gemini_async", model_name, credentials_key(None), _loop_key())
+    return _get_or_create(key, lambda: generative_models.GenerativeModel(model_name))
+
+
+def get_generative_model(model_name: str):
+    """
+    Shared Gemini model. The model holds on to its prediction client after
+    the first request, so reusing the instance keeps the channel warm
+
+    Args:
+        model_name: name of the model (gemini-1.5-flash-001, etc)
+
+    Returns:
+        GenerativeModel
+    """
+    key = ("gemini", model_name, credentials_key(None))
+    return _get_or_create(key, lambda: generative_models.GenerativeModel(model_name))
+
+
+def shutdown():
+    """
+    Close all pooled clients and empty the registry. Clients are lazily
+    recreated if a helper is called after shutdown
+    """
+    with _lock:
+        clients = list(_clients.items())
+        _clients.clear()
+
+    for key, client in clients:
+        if key[0].endswith("_async"):
+            # closing async transports needs their (possibly closed) event loop
+            continue
+        try:
+            if hasattr(client, "transport"):
+                client.transport.close()
+            elif hasattr(client, "close"):
+                client.close()
+        except Exception as e:
+            print(f"Failed to close client {key}: {e}")
+
+
+# make sure channels and connection pools are released on interpreter exit
+atexit.register(shutdown)
@@ -1,33 +1,133 @@
 import os
+import threading
+import functools
+from types import MappingProxyType
 import requests
 from dotenv import load_dotenv
 
+
+class Settings:
+    """
+    Immutable snapshot of the configuration. The environment (and any local
+    .env) is read once, and each setting is parsed the first time it is used
+    and then reused, so request handlers do no config lookups or parsing.
+    Use get_settings() for the current snapshot and reload_settings() to
+    take a new one
+    """
+    def __init__(self):
+        # attempt to load any local .env
+        load_dotenv()
+        self.env = MappingProxyType(dict(os.environ))
+        self._values = {}
+
+    def get(self, name: str, default: str | None = None):
+        return self.env.get(name, default)
+
+
+_settings = None
+_settings_lock = threading.Lock()
+
+# accessors and the arguments to check them with when settings are loaded
+_accessors = []
+
+
+def setting(fn=None, *, validate: bool = True, validate_for: tuple = ((),)):
+    """
+    Decorator for config accessors: the value is computed once per settings
+    snapshot and then reused
+
+    Args:
+        validate: check the value when settings are loaded; turn off for
+            settings that need network calls
+        validate_for: arguments to check an accessor that takes arguments with
+    """
+    def decorate(fn):
+        name = fn.__qualname__
+
+        @functools.wraps(fn)
+        def accessor(*args):
+            values = _settings._values
+            key = (name, *args)
+            if key not in values:
+                values[key] = fn(*args)
+            return values[key]
+
+        if validate:
+            _accessors.append((accessor, [args if isinstance(args, tuple) else (args,) for args in validate_for]))
+        return accessor
+
+    return decorate(fn) if fn is not None else decorate
+
+
+def _env(name: str, default: str | None = None):
+    return _settings.get(name, default)
+
+
+def get_settings():
+    """
+    Current settings snapshot
+    """
+    return _settings
+
+
+def reload_settings():
+    """
+    Take a new settings snapshot from the environment (and local .env) and
+    validate it; if it is invalid the previous snapshot is kept. Objects
+    already built from settings (clients, caches, limiters, the pipeline)
+    keep the values they were built with
+
+    Raises:
+        ValueError listing every setting that could not be parsed
+    """
+    global _settings
+
+    with _settings_lock:
+        previous, _settings = _settings, Settings()
+        errors = []
+        for accessor, arg_list in _accessors:
+            for args in arg_list:
+                try:
+                    accessor(*args)
+                except (ValueError, TypeError) as e:
+                    errors.append(f"{accessor.__qualname__}({', '.join(args)}): {e}")
+
+        if errors:
+            if previous is not None:
+                _settings = previous
+            raise ValueError("Invalid configuration:\n" + "\n".join(errors))
+
+    return _settings
+
+
 class ProjectConfig:
     """
     Config class for project settings
     """
-    # attempt to load any local .env
-    load_dotenv()
 
+    @setting
     def get_logo():
         """
         To use a custom logo, set the DEMO_LOGO env variable and 
         save the file in the images directory
         """
-        value = os.environ.get("DEMO_LOGO", "GoogleCloud_logo.png")
+        value = _env("DEMO_LOGO", "GoogleCloud_logo.png")
         return value
 
+    @setting(validate=False)
     def get_project_id():
         """
         If the PROJECT_ID is not set, will try to use the metadata
-        server to get the current PROJECT_ID
+        server to get the current PROJECT_ID (once; the result is kept
+        with the rest of the settings)
         """
-        value = os.environ.get("PROJECT_ID")
+        value = _env("PROJECT_ID")
 
         if value is None:
             metadata_url = "http://metadata.google.internal/computeMetadata/v1/project/project-id"
             headers = {"Metadata-Flavor": "Google"}
-            response = requests.get(metadata_url, headers=headers)
+            timeout = float(_env("METADATA_TIMEOUT_SECONDS", "5"))
+            response = requests.get(metadata_url, headers=headers, timeout=timeout)
 
             if response.status_code != 200:
                 print("Failed to get project ID:", response.status_code)
@@ -44,128 +144,631 @@ class SummaryParserConfig:
     """
     Config class for the Summary Parser settings
     """
-    # attempt to load any local .env
-    load_dotenv()
 
     # gcs bucket where to upload the file to be summarized
+    @setting
     def upload_bucket():
-        value = os.environ.get("SUMMARY_UPLOAD_BUCKET", "ww-genai-demo-upload-bucket")
+        value = _env("SUMMARY_UPLOAD_BUCKET", "ww-genai-demo-upload-bucket")
         return value
     
     # gcs bucket for where the parser output will go
+    @setting
     def output_bucket():
-        value = os.environ.get("SUMMARY_OUTPUT_BUCKET", "ww-genai-demo-output-bucket")
+        value = _env("SUMMARY_OUTPUT_BUCKET", "ww-genai-demo-output-bucket")
         return value
 
     # location of the processor (us, global, etc)
+    @setting
     def location():
-        value = os.environ.get("SUMMARY_LOCATION", "us")
+        value = _env("SUMMARY_LOCATION", "us")
         return value
 
     # processor id of the parser
+    @setting
     def processor_id():
-        value = os.environ.get("SUMMARY_PROCESSOR_ID", "283ec8851725fcbe")
+        value = _env("SUMMARY_PROCESSOR_ID", "283ec8851725fcbe")
         return value
     
     # mime type of input file (https://cloud.google.com/document-ai/docs/file-types)
+    @setting
     def mime_type():
-        value = os.environ.get("SUMMARY_MIME_TYPE", "application/pdf")
+        value = _env("SUMMARY_MIME_TYPE", "application/pdf")
         return value
     
     # field mask to define list of fields that a request shoudl return
     # https://developers.google.com/docs/api/how-tos/field-masks
     # https://cloud.google.com/ruby/docs/reference/google-cloud-document_ai-v1/latest/Google-Protobuf-FieldMask
+    @setting
     def field_mask():
-        value = os.environ.get("SUMMARY_FIELD_MASK", "text,entities,pages.pageNumber")
+        value = _env("SUMMARY_FIELD_MASK", "text,entities,pages.pageNumber")
         return value
 
 class ContractParserConfig:
     """
     Config class for the Contract Parser settings
     """
-    # attempt to load local .env
-    load_dotenv()
 
     # gcs bucket where to upload the file to be summarized
+    @setting
     def upload_bucket():
-        value = os.environ.get("CONTRACT_UPLOAD_BUCKET", "ww-genai-demo-upload-bucket")
+        value = _env("CONTRACT_UPLOAD_BUCKET", "ww-genai-demo-upload-bucket")
         return value
         
     # gcs bucket for where the parser output will go
+    @setting
     def output_bucket():
-        value = os.environ.get("CONTRACT_OUTPUT_BUCKET", "ww-genai-demo-output-bucket")
+        value = _env("CONTRACT_OUTPUT_BUCKET", "ww-genai-demo-output-bucket")
         return value
 
     # location of the processor (us, global, etc)
+    @setting
     def location():
-        value = os.environ.get("CONTRACT_LOCATION", "us")
+        value = _env("CONTRACT_LOCATION", "us")
         return value
 
     # processor id of the parser
+    @setting
     def processor_id():
-        value = os.environ.get("CONTRACT_PROCESSOR_ID", "283ec8851725fcbe")
+        value = _env("CONTRACT_PROCESSOR_ID", "283ec8851725fcbe")
         return value
     
     # mime type of input file (https://cloud.google.com/document-ai/docs/file-types)
+    @setting
     def mime_type():
-        value = os.environ.get("CONTRACT_MIME_TYPE", "application/pdf")
+        value = _env("CONTRACT_MIME_TYPE", "application/pdf")
         return value
     
     # field mask to define list of fields that a request shoudl return
     # https://developers.google.com/docs/api/how-tos/field-masks
     # https://cloud.google.com/ruby/docs/reference/google-cloud-document_ai-v1/latest/Google-Protobuf-FieldMask
+    @setting
     def field_mask():
-        value = os.environ.get("CONTRACT_FIELD_MASK", "text,entities,pages.pageNumber")
+        value = _env("CONTRACT_FIELD_MASK", "text,entities,pages.pageNumber")
+        return value
+
+    # project the contract parser is in (when it is in another GCP project)
+    @setting
+    def project_id():
+        value = _env("CONTRACT_PROJECT_ID")
+        return value
+
+    # service account key file used to access the contract parser's project
+    @setting
+    def service_account_key():
+        value = _env("CONTRACT_PROJECT_SA_KEY")
         return value
 
 class GeminiConfig:
     """
     Config class for Gemini model
     """
-    # attempt to load local .env
-    load_dotenv()
 
     # set the model to use for the LLM (gemini-1.5-flash-001, gemini-1.5-pro-001, etc)
+    @setting
     def model():
-        value = os.environ.get("model", "gemini-1.5-flash-001") 
+        value = _env("model", "gemini-1.5-flash-001") 
         return value
     
     # temperature of the model (0-1 or 0-2 depending on model)
+    @setting
     def temperature():
-        value = float(os.environ.get("temperature", "1"))
+        value = float(_env("temperature", "1"))
         return value
     
     # define top K for the model
+    @setting
     def top_k():
-        value = int(os.environ.get("top_k", "5"))
+        value = int(_env("top_k", "5"))
         return value
     
     # defint top P for the model
+    @setting
     def top_p():
-        value = float(os.environ.get("top_p", "1"))
-        return value    
+        value = float(_env("top_p", "1"))
+        return value
+
+    # max tokens of a document QA prompt (instructions, context and chat history)
+    @setting
+    def max_prompt_tokens():
+        value = int(_env("GEMINI_MAX_PROMPT_TOKENS", "32000"))
+        return value
+
+    # share of the prompt budget that recent chat history may use
+    @setting
+    def history_token_share():
+        value = float(_env("GEMINI_HISTORY_TOKEN_SHARE", "0.2"))
+        return value
+
+    # count prompt tokens with the model's count_tokens api instead of estimating locally
+    @setting
+    def exact_token_count():
+        value = _env("GEMINI_EXACT_TOKEN_COUNT", "false").lower() == "true"
+        return value
+
+    # seconds to wait for an answer (the first chunk when streaming); 0 to wait forever
+    @setting
+    def timeout_seconds():
+        value = float(_env("GEMINI_TIMEOUT_SECONDS", "60"))
+        return value
+
+    # fire a second request when the first is slower than usual (see HedgeConfig)
+    @setting
+    def hedge():
+        value = _env("GEMINI_HEDGE", "false").lower() == "true"
+        return value
 
 class DiscoveryEngineConfig:
     """
     Config class for the Discovery Engine API
     """
-    # attempt to load local .env
-    load_dotenv()
 
     # engine id of the search engine
+    @setting
     def engine_id():
-        value = os.environ.get("DISCOVERY_ENGINE_ID", "")
+        value = _env("DISCOVERY_ENGINE_ID", "")
         return value
 
     # location of the search engine (us, global, etc)
+    @setting
     def location():
-        value = os.environ.get("DISCOVERY_ENGINE_LOCATION", "")
+        value = _env("DISCOVERY_ENGINE_LOCATION", "")
+        return value
+
+    # set to false to always call the search api
+    @setting
+    def cache_enabled():
+        value = _env("SEARCH_CACHE_ENABLED", "true").lower() == "true"
+        return value
+
+    # how long search results are reused
+    @setting
+    def cache_ttl_seconds():
+        value = int(_env("SEARCH_CACHE_TTL_SECONDS", "600"))
+        return value
+
+    # max number of search results kept
+    @setting
+    def cache_max_entries():
+        value = int(_env("SEARCH_CACHE_MAX_ENTRIES", "256"))
+        return value
+
+    # seconds to wait for a search response; 0 to wait forever
+    @setting
+    def timeout_seconds():
+        value = float(_env("SEARCH_TIMEOUT_SECONDS", "30"))
+        return value
+
+    # fire a second request when the first is slower than usual (see HedgeConfig)
+    @setting
+    def hedge():
+        value = _env("SEARCH_HEDGE", "false").lower() == "true"
         return value
 
 
 class AudioConfig:
-    load_dotenv()
 
+    @setting
     def upload_bucket():
-        value = os.environ.get("AUDIO_UPLOAD_BUCKET", "")
+        value = _env("AUDIO_UPLOAD_BUCKET", "")
+        return value
+
+
+class ClientConfig:
+    """
+    Config class for the shared GCP client pool
+    """
+
+    # max number of pooled http connections per storage client
+    @setting
+    def pool_size():
+        value = int(_env("CLIENT_POOL_SIZE", "32"))
+        return value
+
+class StorageConfig:
+    """
+    Config class for Cloud Storage helpers
+    """
+
+    # max number of parser output shards to download concurrently
+    @setting
+    def download_workers():
+        value = int(_env("STORAGE_DOWNLOAD_WORKERS", "8"))
+        return value
+
+    # parse parser output shards as a stream, keeping only the field mask fields
+    @setting
+    def streaming_parse():
+        value = _env("STORAGE_STREAMING_PARSE", "true").lower() == "true"
+        return value
+
+class DocumentCacheConfig:
+    """
+    Config class for the cache of processed documents
+    """
+
+    # set to false to always re-upload and re-process documents
+    @setting
+    def enabled():
+        value = _env("DOCUMENT_CACHE_ENABLED", "true").lower() == "true"
+        return value
+
+    # local sqlite file where processed documents are stored
+    @setting
+    def path():
+        value = _env("DOCUMENT_CACHE_PATH", ".cache/documents.sqlite3")
+        return value
+
+    # max size of the cache in MB; least recently used documents are evicted
+    @setting
+    def max_mb():
+        value = int(_env("DOCUMENT_CACHE_MAX_MB", "512"))
+        return value
+
+class DocAIConfig:
+    """
+    Config class for Document AI processing settings
+    """
+
+    # documents with at most this many pages are processed online (synchronously)
+    # set to 0 to always use batch processing
+    @setting
+    def online_max_pages():
+        value = int(_env("DOCAI_ONLINE_MAX_PAGES", "15"))
+        return value
+
+    # max file size in MB for online processing
+    @setting
+    def online_max_mb():
+        value = float(_env("DOCAI_ONLINE_MAX_MB", "20"))
+        return value
+
+    # seconds between status polls of a batch process operation
+    @setting
+    def poll_interval():
+        value = float(_env("DOCAI_POLL_INTERVAL", "2"))
+        return value
+
+    # split large pdfs into page ranges and process them concurrently
+    @setting
+    def fanout_enabled():
+        value = _env("DOCAI_FANOUT", "false").lower() == "true"
         return value
+
+    # pages per request when splitting large pdfs
+    @setting
+    def chunk_pages():
+        value = int(_env("DOCAI_CHUNK_PAGES", "15"))
+        return value
+
+    # max concurrent document ai requests for one document; keep under the processor quota
+    @setting
+    def max_concurrent_requests():
+        value = int(_env("DOCAI_MAX_CONCURRENT_REQUESTS", "5"))
+        return value
+
+class RetrievalConfig:
+    """
+    Config class for retrieval of relevant passages for document QA
+    """
+
+    # set to false to always send the whole document as context
+    @setting
+    def enabled():
+        value = _env("RETRIEVAL_ENABLED", "true").lower() == "true"
+        return value
+
+    # documents up to this many characters are sent whole as context
+    @setting
+    def full_context_max_chars():
+        value = int(_env("RETRIEVAL_FULL_CONTEXT_MAX_CHARS", "40000"))
+        return value
+
+    # number of words per indexed passage
+    @setting
+    def chunk_words():
+        value = int(_env("RETRIEVAL_CHUNK_WORDS", "200"))
+        return value
+
+    # number of words shared by consecutive passages
+    @setting
+    def chunk_overlap():
+        value = int(_env("RETRIEVAL_CHUNK_OVERLAP", "40"))
+        return value
+
+    # number of passages to put in the prompt
+    @setting
+    def top_k():
+        value = int(_env("RETRIEVAL_TOP_K", "8"))
+        return value
+
+class ContextCacheConfig:
+    """
+    Config class for Vertex AI context caching of document QA grounding text
+    """
+
+    # set to true to hold large documents in a cached context. Off by default:
+    # a cached context holds the whole document, so questions on it skip the
+    # passage retrieval and prompt budget (see RetrievalConfig, GeminiConfig)
+    @setting
+    def enabled():
+        value = _env("CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+        return value
+
+    # how long a cached context lives without being used
+    @setting
+    def ttl_seconds():
+        value = int(_env("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+        return value
+
+    # minimum size of grounding text worth caching (the api has a minimum too)
+    @setting
+    def min_tokens():
+        value = int(_env("CONTEXT_CACHE_MIN_TOKENS", "32768"))
+        return value
+
+    # models that support context caching (comma separated)
+    @setting
+    def models():
+        value = _env("CONTEXT_CACHE_MODELS", "gemini-1.5-pro-001,gemini-1.5-pro-002,gemini-1.5-flash-001,gemini-1.5-flash-002")
+        return tuple(m.strip() for m in value.split(",") if m.strip())
+
+class AnswerCacheConfig:
+    """
+    Config class for the cache of document QA answers
+    """
+
+    # set to false to always ask the model
+    @setting
+    def enabled():
+        value = _env("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+        return value
+
+    # max number of answers kept in memory
+    @setting
+    def max_entries():
+        value = int(_env("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+        return value
+
+    # how long an answer is reused
+    @setting
+    def ttl_seconds():
+        value = int(_env("ANSWER_CACHE_TTL_SECONDS", "86400"))
+        return value
+
+    # answers are not cached when the model temperature is above this
+    @setting
+    def max_temperature():
+        value = float(_env("ANSWER_CACHE_MAX_TEMPERATURE", "1"))
+        return value
+
+    # also cache follow up questions (the answer may depend on the conversation)
+    @setting
+    def with_history():
+        value = _env("ANSWER_CACHE_WITH_HISTORY", "false").lower() == "true"
+        return value
+
+    # local sqlite file to persist answers to; empty to keep them in memory only
+    @setting
+    def path():
+        value = _env("ANSWER_CACHE_PATH", "")
+        return value
+
+    # max size of the persisted answers in MB
+    @setting
+    def max_mb():
+        value = int(_env("ANSWER_CACHE_MAX_MB", "64"))
+        return value
+
+
+class CredentialsConfig:
+    """
+    Config class for service account credentials (see gcp_functions.credentials)
+    """
+
+    # refresh access tokens this many seconds before they expire
+    @setting
+    def refresh_margin_seconds():
+        value = int(_env("CREDENTIALS_REFRESH_MARGIN_SECONDS", "300"))
+        return value
+
+    # seconds to wait before trying again after a failed refresh
+    @setting
+    def retry_seconds():
+        value = int(_env("CREDENTIALS_RETRY_SECONDS", "30"))
+        return value
+
+
+class HedgeConfig:
+    """
+    Config class for hedged requests (see gcp_functions.hedging)
+    """
+
+    # a request is hedged once it is slower than this percentile of recent requests
+    @setting
+    def percentile():
+        value = float(_env("HEDGE_PERCENTILE", "95"))
+        if not 0 < value <= 100:
+            raise ValueError(f"HEDGE_PERCENTILE must be in (0, 100], got {value}")
+        return value
+
+    # number of recent request latencies the percentile is taken over
+    @setting
+    def window():
+        value = int(_env("HEDGE_WINDOW", "200"))
+        return value
+
+    # no hedging until this many latencies have been seen
+    @setting
+    def min_samples():
+        value = int(_env("HEDGE_MIN_SAMPLES", "20"))
+        return value
+
+
+class RateLimitConfig:
+    """
+    Config class for the request limiters (see gcp_functions.ratelimit).
+    Each setting can be overridden per service, e.g. GEMINI_QPS or
+    DOCUMENTAI_MAX_CONCURRENCY
+    """
+
+    # services requests are limited for
+    services = ("documentai", "discoveryengine", "gemini")
+
+    def _get(service, name, default):
+        return _env(f"{service.upper()}_{name}", _env(f"RATE_LIMIT_{name}", default))
+
+    # requests per second
+    @setting(validate_for=services)
+    def qps(service):
+        value = float(RateLimitConfig._get(service, "QPS", "10"))
+        if value <= 0:
+            raise ValueError(f"{service.upper()}_QPS / RATE_LIMIT_QPS must be above 0, got {value}")
+        return value
+
+    # requests that can be made at once after being idle
+    @setting(validate_for=services)
+    def burst(service):
+        value = int(RateLimitConfig._get(service, "BURST", "10"))
+        if value < 1:
+            raise ValueError(f"{service.upper()}_BURST / RATE_LIMIT_BURST must be at least 1, got {value}")
+        return value
+
+    # max requests in flight; lowered automatically on quota errors
+    @setting(validate_for=services)
+    def max_concurrency(service):
+        value = int(RateLimitConfig._get(service, "MAX_CONCURRENCY", "16"))
+        if value < 1:
+            raise ValueError(f"{service.upper()}_MAX_CONCURRENCY / RATE_LIMIT_MAX_CONCURRENCY must be at least 1, got {value}")
+        return value
+
+    # retries of a request that failed with a quota error
+    @setting
+    def max_retries():
+        value = int(_env("RATE_LIMIT_MAX_RETRIES", "5"))
+        return value
+
+    # seconds of the first retry backoff; doubled on every retry
+    @setting
+    def backoff_base():
+        value = float(_env("RATE_LIMIT_BACKOFF_BASE", "1"))
+        return value
+
+    # max seconds of a retry backoff
+    @setting
+    def backoff_max():
+        value = float(_env("RATE_LIMIT_BACKOFF_MAX", "30"))
+        return value
+
+
+class PipelineConfig:
+    """
+    Config class for the document processing pipeline (see gcp_functions.pipeline)
+    """
+
+    # files hashed, looked up and uploaded at the same time
+    @setting
+    def upload_workers():
+        value = int(_env("PIPELINE_UPLOAD_WORKERS", "8"))
+        return value
+
+    # DocAI requests (online requests or batch jobs) in flight at the same time
+    @setting
+    def ocr_workers():
+        value = int(_env("PIPELINE_OCR_WORKERS", "4"))
+        return value
+
+    # outputs parsed at the same time
+    @setting
+    def parse_workers():
+        value = int(_env("PIPELINE_PARSE_WORKERS", "4"))
+        return value
+
+    # processes outputs are parsed in; 0 to parse on threads instead
+    @setting
+    def parse_processes():
+        value = int(_env("PIPELINE_PARSE_PROCESSES", "2"))
+        return value
+
+    # max items waiting in front of each stage; submitting waits when full
+    @setting
+    def queue_size():
+        value = int(_env("PIPELINE_QUEUE_SIZE", "32"))
+        return value
+
+    # how long finished jobs can still be polled
+    @setting
+    def job_ttl_seconds():
+        value = int(_env("PIPELINE_JOB_TTL_SECONDS", "3600"))
+        return value
+
+
+
+class TextStoreConfig:
+    """
+    Config class for the shared store of session documents (see gcp_functions.text_store)
+    """
+
+    # set to false to keep texts uncompressed
+    @setting
+    def compress():
+        value = _env("TEXT_STORE_COMPRESS", "true").lower() == "true"
+        return value
+
+    # texts with at least this many characters are compressed
+    @setting
+    def compress_min_chars():
+        value = int(_env("TEXT_STORE_COMPRESS_MIN_CHARS", "4096"))
+        return value
+
+    # zlib compression level (1 is fastest, 9 is smallest)
+    @setting
+    def compress_level():
+        value = int(_env("TEXT_STORE_COMPRESS_LEVEL", "1"))
+        return value
+
+
+class SessionStoreConfig:
+    """
+    Config class for the shared session store (see gcp_functions.session_store)
+    """
+
+    # where sessions are kept besides the process: memory, sqlite or redis;
+    # empty to only keep them in the process (a single app process)
+    @setting
+    def backend():
+        value = _env("SESSION_STORE", "").lower()
+        return value
+
+    # sqlite file for SESSION_STORE=sqlite
+    @setting
+    def path():
+        value = _env("SESSION_STORE_PATH", ".cache/sessions.sqlite3")
+        return value
+
+    # server url for SESSION_STORE=redis
+    @setting
+    def url():
+        value = _env("SESSION_STORE_URL", "redis://localhost:6379/0")
+        return value
+
+    # seconds a session is kept after its last event
+    @setting
+    def ttl_seconds():
+        value = int(_env("SESSION_TTL_SECONDS", "86400"))
+        return value
+
+
+class WarmupConfig:
+    """
+    Config class for the warm-up run after start up (see gcp_functions.warmup)
+    """
+
+    # set to false to create clients and credentials on first use instead
+    @setting
+    def enabled():
+        value = _env("WARMUP_ENABLED", "true").lower() == "true"
+        return value
+
+
+# take the settings snapshot at import, failing fast on invalid values
+reload_settings()
@@ -0,0 +1,240 @@
+import atexit
+import datetime
+import hashlib
+import threading
+import time
+from .config import ContextCacheConfig
+from .prompt import estimate_tokens
+from .lazy import lazy_import
+
+caching = lazy_import("vertexai.preview.caching")
+preview_generative_models = lazy_import("vertexai.preview.generative_models")
+generative_models = lazy_import("vertexai.generative_models")
+
+
+class VertexCacheBackend:
+    """
+    Backend over the Vertex AI context caching api. ContextCacheManager
+    only talks to its backend through these methods, so a local fake with
+    the same methods can stand in for it (see MemoryCacheBackend)
+    """
+    def create(self, model_name: str, text: str, ttl: datetime.timedelta):
+        contents = [generative_models.Content(role="user", parts=[generative_models.Part.from_text(text)])]
+        return caching.CachedContent.create(model_name=model_name, contents=contents, ttl=ttl)
+
+    def model(self, cached):
+        return preview_generative_models.GenerativeModel.from_cached_content(cached_content=cached)
+
+    def extend(self, cached, ttl: datetime.timedelta):
+        cached.update(ttl=ttl)
+
+    def delete(self, cached):
+        cached.delete()
+
+
+class MemoryCacheBackend:
+    """
+    Local stand-in for VertexCacheBackend that keeps cached contexts in
+    memory, for running ContextCacheManager without Vertex AI (e.g. in
+    tests). Records what was asked of it
+
+    Args:
+        fail: Optional. raise on create, like a model or text the api refuses
+    """
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        # name -> {"model_name", "text", "ttl"} of the cached contexts alive
+        self.contexts = {}
+        self.created = 0
+        self.extended = 0
+        self.deleted = 0
+        self._lock = threading.Lock()
+
+    def create(self, model_name: str, text: str, ttl: datetime.timedelta):
+        if self.fail:
+            raise ValueError("context caching not available")
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/{self.created}"
+            self.contexts[name] = {"model_name": model_name, "text": text, "ttl": ttl}
+        return name
+
+    def model(self, cached):
+        return ("model", cached)
+
+    def extend(self, cached, ttl: datetime.timedelta):
+        with self._lock:
+            self.extended += 1
+            self.contexts[cached]["ttl"] = ttl
+
+    def delete(self, cached):
+        with self._lock:
+            self.deleted += 1
+            del self.contexts[cached]
+
+
+class _Entry:
+    def __init__(self, cached, model, expires: float):
+        self.cached = cached
+        self.model = model
+        self.expires = expires
+
+
+class ContextCacheManager:
+    """
+    Keeps one cached context per (grounding text, model) so that repeated
+    questions on the same document don't resend the document. Entries are
+    kept alive while they are used, reference counted per session, and
+    deleted when the last session releases them or they expire
+
+    Args:
+        backend: Optional. cache api backend; defaults to VertexCacheBackend
+    """
+    def __init__(self, backend=None):
+        self.backend = backend or VertexCacheBackend()
+        self._entries = {}
+        self._refs = {}
+        # keys that could not be cached; don't retry them on every question
+        self._failed = set()
+        # one lock per key so creating one cache doesn't hold up the others
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _key(self, text: str, model_name: str):
+        return (hashlib.sha256(text.encode("utf-8")).hexdigest(), model_name)
+
+    def qualifies(self, text: str, model_name: str):
+        """
+        Whether the text and model can use a cached context
+        """
+        return (ContextCacheConfig.enabled()
+                and model_name in ContextCacheConfig.models()
+                and estimate_tokens(text) >= ContextCacheConfig.min_tokens())
+
+    def get_model(self, text: str, model_name: str):
+        """
+        Model bound to a cached context holding text, creating the cached
+        context on first use and extending its TTL while it is in use
+
+        Args:
+            text: grounding text of the document
+            model_name: name of the model (see GeminiConfig.model)
+
+        Returns:
+            model to generate with, or None if the text or model doesn't
+            qualify for caching or the cache could not be created
+        """
+        if not self.qualifies(text, model_name):
+            return None
+
+        key = self._key(text, model_name)
+        ttl = ContextCacheConfig.ttl_seconds()
+
+        with self._lock:
+            if key in self._failed:
+                return None
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            now = time.time()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.expires <= now:
+                    # expired server side; forget it and create a new one
+                    del self._entries[key]
+                    entry = None
+
+            if entry is None:
+                try:
+                    print(f"Creating context cache for {key[0][:12]} on {model_name}")
+                    cached = self.backend.create(model_name, text, datetime.timedelta(seconds=ttl))
+                    entry = _Entry(cached, self.backend.model(cached), now + ttl)
+                except Exception as e:
+                    print(f"Context cache not available, sending full context: {e}")
+                    with self._lock:
+                        self._failed.add(key)
+                    return None
+                with self._lock:
+                    self._entries[key] = entry
+            elif entry.expires - now < ttl / 2:
+                # keep entries that are still being used from expiring
+                try:
+                    self.backend.extend(entry.cached, datetime.timedelta(seconds=ttl))
+                    entry.expires = now + ttl
+                except Exception as e:
+                    print(f"Failed to extend context cache: {e}")
+
+            return entry.model
+
+    def invalidate(self, text: str, model_name: str):
+        """
+        Forget the cached context of text, e.g. when the api no longer knows it
+        """
+        with self._lock:
+            self._entries.pop(self._key(text, model_name), None)
+
+    def acquire(self, text_hash: str, model_name: str):
+        """
+        Mark a text as in use by a session of this process
+
+        Args:
+            text_hash: sha256 of the text, e.g. its text store handle (see StateBag.ocr_handle)
+            model_name: name of the model
+        """
+        key = (text_hash, model_name)
+        with self._lock:
+            self._refs[key] = self._refs.get(key, 0) + 1
+
+    def release(self, text_hash: str, model_name: str):
+        """
+        Mark a text as no longer used by a session of this process; the
+        cached context is deleted once no session uses it. Only release what
+        was acquired in this process: the counts are kept per process
+        """
+        key = (text_hash, model_name)
+        with self._lock:
+            refs = self._refs.get(key, 0) - 1
+            if refs > 0:
+                self._refs[key] = refs
+                return
+            self._refs.pop(key, None)
+            self._key_locks.pop(key, None)
+            entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._delete(entry)
+
+    def cleanup(self):
+        """
+        Delete every cached context, e.g. on shutdown
+        """
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+
+        for entry in entries:
+            self._delete(entry)
+
+    def _delete(self, entry: _Entry):
+        try:
+            self.backend.delete(entry.cached)
+        except Exception as e:
+            print(f"Failed to delete context cache: {e}")
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_context_cache():
+    """
+    Process-wide ContextCacheManager
+    """
+    global _manager
+
+    with _manager_lock:
+        if _manager is None:
+            _manager = ContextCacheManager()
+            atexit.register(_manager.cleanup)
+
+    return _manager
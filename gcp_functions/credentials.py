@@ -0,0 +1,91 @@
+import datetime
+import json
+import threading
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+from .config import CredentialsConfig
+
+# scope that covers every api the helpers call; credentials that already have
+# their scopes are used as is by the clients, so they all share one token
+_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+class CredentialsProvider:
+    """
+    Service account credentials loaded once from a key file and kept fresh:
+    a background thread refreshes the access token ahead of its expiry (see
+    CredentialsConfig), so requests never wait on minting a token. The same
+    Credentials object is handed out every time, so the shared clients made
+    with it (see gcp_functions.clients) reuse its token
+
+    Args:
+        key_file: path to the service account key json
+    """
+    def __init__(self, key_file: str):
+        self.key_file = key_file
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def get(self):
+        """
+        The provider's credentials, loading the key file on first use
+        """
+        if self._credentials is not None:
+            return self._credentials
+
+        with self._lock:
+            if self._credentials is None:
+                with open(self.key_file) as f:
+                    info = json.load(f)
+                self._credentials = Credentials.from_service_account_info(info, scopes=_SCOPES)
+                print(f"Loaded service account credentials for {self._credentials.service_account_email}")
+                threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+        return self._credentials
+
+    def stop(self):
+        """
+        Stop refreshing in the background
+        """
+        self._stopped.set()
+
+    def _refresh_loop(self):
+        margin = CredentialsConfig.refresh_margin_seconds()
+        retry = CredentialsConfig.retry_seconds()
+        request = Request()
+
+        while not self._stopped.is_set():
+            try:
+                self._credentials.refresh(request)
+                expiry = self._credentials.expiry
+                # expiry is a naive utc datetime
+                wait = (expiry - datetime.datetime.utcnow()).total_seconds() - margin if expiry else retry
+            except Exception as e:
+                # the clients still refresh the token themselves when it expires
+                print(f"Failed to refresh credentials for {self._credentials.service_account_email}: {e}")
+                wait = retry
+            self._stopped.wait(max(wait, retry))
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_credentials_provider(key_file: str):
+    """
+    Process-wide CredentialsProvider for a service account key file
+    """
+    with _providers_lock:
+        provider = _providers.get(key_file)
+        if provider is None:
+            provider = _providers[key_file] = CredentialsProvider(key_file)
+
+    return provider
+
+
+def get_service_account_credentials(key_file: str):
+    """
+    Shared, automatically refreshed credentials for a service account key file
+    """
+    return get_credentials_provider(key_file).get()
@@ -1,40 +1,34 @@
 from typing import List
-from google.api_core.client_options import ClientOptions
-from google.cloud import discoveryengine_v1 as discoveryengine
+import functools
+import hashlib
+import threading
+import time
 from .config import DiscoveryEngineConfig
+from .clients import get_search_client, get_search_async_client
+from .cache import TTLCache, normalize_query
+from .singleflight import SingleFlight
+from .hedging import Hedger
+from .ratelimit import call_with_retry, call_with_retry_async, _left
+from .lazy import lazy_import
 from urllib.parse import quote
 
-def search(project_id: str, 
-            engine_id: str, 
-            model_context_prompt: str, 
-            search_query: str):
-    '''
-    Search function against Vertex Search / Discovery Engine API
+discoveryengine = lazy_import("google.cloud.discoveryengine_v1")
 
-    Args:
-        project_id: id for the project that hosts the search engine
-        engine_id: id of the vertex agent app
-        model_context_prompt: customize preamble prompt for the model
-        search_query: prompt/question for the search engine
+# identical searches made at the same time share one api call
+_search_flight = SingleFlight("search")
 
-    Returns:
-        summary: summary output that combines the summary text and search results
-        response: raw response of the search engine
-    '''
-    location = DiscoveryEngineConfig.location()
+# deadlines and hedging of search api calls
+_search_hedger = Hedger("search")
 
-    client_options = (
-        ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com")
-        if location != "global"
-        else None
-    )
-
-    # Create a client
-    client = discoveryengine.SearchServiceClient(client_options=client_options)
-
-    # The full resource name of the search app serving config
-    serving_config = f"projects/{project_id}/locations/{location}/collections/default_collection/engines/{engine_id}/servingConfigs/default_config"
+@functools.lru_cache(maxsize=None)
+def _search_specs():
+    """
+    Search specs shared by every request, built on first use (so that the
+    sdk is not imported until then), and a hash of them for cache keys
 
+    Returns:
+        (content_search_spec, query_expansion_spec, spell_correction_spec, spec_hash)
+    """
     # Optional: Configuration options for search
     # Refer to the `ContentSearchSpec` reference for all supported fields:
     # https://cloud.google.com/python/docs/reference/discoveryengine/latest/google.cloud.discoveryengine_v1.types.SearchRequest.ContentSearchSpec
@@ -64,6 +58,152 @@ def search(project_id: str,
         )
     )
 
+    query_expansion_spec = discoveryengine.SearchRequest.QueryExpansionSpec(
+        condition=discoveryengine.SearchRequest.QueryExpansionSpec.Condition.AUTO,
+    )
+
+    spell_correction_spec = discoveryengine.SearchRequest.SpellCorrectionSpec(
+        mode=discoveryengine.SearchRequest.SpellCorrectionSpec.Mode.AUTO
+    )
+
+    # changes whenever the specs above change, so cached results of other specs are not reused
+    spec_hash = hashlib.sha256(
+        discoveryengine.SearchRequest.ContentSearchSpec.serialize(content_search_spec)
+        + discoveryengine.SearchRequest.QueryExpansionSpec.serialize(query_expansion_spec)
+        + discoveryengine.SearchRequest.SpellCorrectionSpec.serialize(spell_correction_spec)
+    ).hexdigest()[:16]
+
+    return content_search_spec, query_expansion_spec, spell_correction_spec, spec_hash
+
+
+_results = None
+_results_lock = threading.Lock()
+
+
+def get_search_cache():
+    """
+    Process-wide cache of search results, or None if it is disabled
+    (see DiscoveryEngineConfig.cache_enabled)
+    """
+    global _results
+
+    if not DiscoveryEngineConfig.cache_enabled():
+        return None
+
+    with _results_lock:
+        if _results is None:
+            _results = TTLCache(DiscoveryEngineConfig.cache_max_entries(),
+                                DiscoveryEngineConfig.cache_ttl_seconds())
+
+    return _results
+
+
+def search(project_id: str, 
+            engine_id: str, 
+            model_context_prompt: str, 
+            search_query: str):
+    '''
+    Search function against Vertex Search / Discovery Engine API
+
+    Args:
+        project_id: id for the project that hosts the search engine
+        engine_id: id of the vertex agent app
+        model_context_prompt: customize preamble prompt for the model
+        search_query: prompt/question for the search engine
+
+    Returns:
+        summary: summary output that combines the summary text and search results
+        response: raw response of the search engine
+
+    Results are cached for the same engine and (normalized) query; see
+    DiscoveryEngineConfig.cache_ttl_seconds(). Concurrent identical searches
+    (e.g. from several sessions) share one api call and all get its result.
+    The call gives up after DiscoveryEngineConfig.timeout_seconds(), and can be
+    hedged when slow (see DiscoveryEngineConfig.hedge)
+    '''
+    location = DiscoveryEngineConfig.location()
+    key = _search_key(project_id, engine_id, location, search_query)
+
+    results = get_search_cache()
+    if results is not None:
+        cached = results.get(key)
+        if cached is not None:
+            print(f"Search cache hit {results.stats()}")
+            return cached
+
+    result = _search_flight.do(key, _search, project_id, engine_id, location, search_query)
+
+    if results is not None:
+        results.put(key, result)
+
+    return result
+
+async def search_async(project_id: str,
+                       engine_id: str,
+                       model_context_prompt: str,
+                       search_query: str):
+    '''
+    Async version of search, on the async client. Shares the result cache
+    and in-flight calls with search
+    '''
+    location = DiscoveryEngineConfig.location()
+    key = _search_key(project_id, engine_id, location, search_query)
+
+    results = get_search_cache()
+    if results is not None:
+        cached = results.get(key)
+        if cached is not None:
+            print(f"Search cache hit {results.stats()}")
+            return cached
+
+    result = await _search_flight.do_async(key, _search_async, project_id, engine_id, location, search_query)
+
+    if results is not None:
+        results.put(key, result)
+
+    return result
+
+def _search_key(project_id: str, engine_id: str, location: str, search_query: str):
+    return f"{project_id}:{engine_id}:{location}:{_search_specs()[3]}:{normalize_query(search_query)}"
+
+def _search(project_id: str, engine_id: str, location: str, search_query: str):
+    # shared client for the location
+    client = get_search_client(location)
+    request = _search_request(project_id, engine_id, location, search_query)
+
+    deadline = DiscoveryEngineConfig.timeout_seconds() or None
+    end = time.monotonic() + deadline if deadline else None
+    # waits, retries and the rpc itself all end with the deadline, so that a
+    # call the hedger stopped waiting for doesn't linger
+    response = _search_hedger.call(lambda: call_with_retry("discoveryengine", project_id, location,
+                                                           lambda: client.search(request, timeout=_left(end)),
+                                                           deadline=_left(end)),
+                                   deadline=deadline,
+                                   hedge=DiscoveryEngineConfig.hedge())
+
+    return format_results(response), response
+
+async def _search_async(project_id: str, engine_id: str, location: str, search_query: str):
+    client = get_search_async_client(location)
+    request = _search_request(project_id, engine_id, location, search_query)
+
+    deadline = DiscoveryEngineConfig.timeout_seconds() or None
+    end = time.monotonic() + deadline if deadline else None
+    response = await _search_hedger.call_async(
+        lambda: call_with_retry_async("discoveryengine", project_id, location,
+                                      lambda: client.search(request, timeout=_left(end)),
+                                      deadline=_left(end)),
+        deadline=deadline,
+        hedge=DiscoveryEngineConfig.hedge())
+
+    return format_results(response), response
+
+def _search_request(project_id: str, engine_id: str, location: str, search_query: str):
+    # The full resource name of the search app serving config
+    serving_config = f"projects/{project_id}/locations/{location}/collections/default_collection/engines/{engine_id}/servingConfigs/default_config"
+
+    content_search_spec, query_expansion_spec, spell_correction_spec, spec_hash = _search_specs()
+
     # Refer to the `SearchRequest` reference for all supported fields:
     # https://cloud.google.com/python/docs/reference/discoveryengine/latest/google.cloud.discoveryengine_v1.types.SearchRequest
     request = discoveryengine.SearchRequest(
@@ -71,15 +211,17 @@ def search(project_id: str,
         query=search_query,
         page_size=10,
         content_search_spec=content_search_spec,
-        query_expansion_spec=discoveryengine.SearchRequest.QueryExpansionSpec(
-            condition=discoveryengine.SearchRequest.QueryExpansionSpec.Condition.AUTO,
-        ),
-        spell_correction_spec=discoveryengine.SearchRequest.SpellCorrectionSpec(
-            mode=discoveryengine.SearchRequest.SpellCorrectionSpec.Mode.AUTO
-        ),
+        query_expansion_spec=query_expansion_spec,
+        spell_correction_spec=spell_correction_spec,
     )
 
-    response = client.search(request)
+    return request
+
+def format_results(response):
+    '''
+    Summary text of a search response followed by its top results, with
+    links to the source documents
+    '''
     summary = response.summary.summary_text
 
     # only returning 2 search results for purposes of demo
@@ -101,4 +243,4 @@ def search(project_id: str,
             count = count + 1
     #print (response)
 
-    return summary, response
+    return summary
@@ -1,75 +1,673 @@
+from __future__ import annotations
 from typing import Optional
-from google.api_core.client_options import ClientOptions
-from google.cloud import documentai as docai
 from google.api_core.exceptions import InternalServerError
 from google.api_core.exceptions import RetryError
 from google.oauth2.service_account import Credentials
+from .clients import get_docai_client, get_docai_async_client, credentials_key
+from .config import DocAIConfig
+from .storage import OutputShard, collect_output
+from .singleflight import SingleFlight
+from .ratelimit import call_with_retry, call_with_retry_async
+from .lazy import lazy_import
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import io
-import json
+import os
+import re
 
-def process_document(
+docai = lazy_import("google.cloud.documentai")
+operation_async = lazy_import("google.api_core.operation_async")
+
+# optional; needed to split large pdfs into page ranges
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# identical batch requests made at the same time share one operation
+_batch_flight = SingleFlight("docai batch")
+
+# matches page objects (but not the /Pages tree nodes) in a pdf
+_PDF_PAGE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+def count_pages(file_url: str, mime_type: str):
+    """
+    Page count of a local file. Non-PDF files are counted as a single page
+
+    Args:
+        file_url: local file path
+        mime_type: file type of the file
+
+    Returns:
+        number of pages
+    """
+    if mime_type != "application/pdf":
+        return 1
+
+    if pypdf is not None:
+        return len(pypdf.PdfReader(file_url).pages)
+
+    # scan the raw pdf for page objects; cheap and needs no pdf library,
+    # but can't see pages inside compressed object streams
+    with open(file_url, "rb") as f:
+        count = len(_PDF_PAGE.findall(f.read()))
+
+    return max(count, 1)
+
+def use_online_processing(file_url: str, mime_type: str):
+    """
+    Whether a local file is small enough to be processed online (see
+    DocAIConfig.online_max_pages and DocAIConfig.online_max_mb)
+
+    Args:
+        file_url: local file path
+        mime_type: file type of the file
+
+    Returns:
+        True if the file should be processed with process_document_online
+    """
+    max_pages = DocAIConfig.online_max_pages()
+    if max_pages <= 0:
+        return False
+
+    if os.path.getsize(file_url) > DocAIConfig.online_max_mb() * 1024 * 1024:
+        return False
+
+    return count_pages(file_url, mime_type) <= max_pages
+
+def process_document_online(
     project_id: str,
     location: str,
     processor_id: str,
     mime_type: str,
-    gcs_input_uri: str,
-    gcs_output_uri: str,
+    file_url: str,
     field_mask: Optional[str] = None,
     processor_version_id: Optional[str] = None,
     credentials: Optional[Credentials] = None
 ):
     """
-    Send a batch process request to the document AI processor
+    Send an online (synchronous) process request to the document AI processor.
+    The file content is sent inline, so there is no upload to cloud storage,
+    no long running operation and no output to read back from a bucket
 
     Args:
         project_id: project id where processor is created
         location: location of the processor (us, global, etc)
         processor_id: id of the parser
         mime_type: file type that is being processed
-        gcs_input_uri: the cloud storage URI of the file to be processed
-        gcs_output_uri: the cloud storage URI of the folder where output gets sent
+        file_url: local file path of the file to be processed
         field_mask: Optional. list of fields that a request should return
         processor_version_id: Optional. set to specify particular version of a model
         credentials: Optional. credentials to run as
 
     Returns:
-       BatchProcessMetadata 
+       Document
     """
-    # You must set the `api_endpoint` if you use a location other than "us".
-    opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+    client = get_docai_client(location, credentials)
+    name = _processor_name(client, project_id, location, processor_id, processor_version_id)
 
-    # if no credentials, will use the default application credentials
-    if credentials != None:
-        client = docai.DocumentProcessorServiceClient(client_options=opts, credentials=credentials)
-    else:
-        client = docai.DocumentProcessorServiceClient(client_options=opts)
+    with open(file_url, "rb") as f:
+        content = f.read()
 
-    gcs_document = docai.GcsDocument(gcs_uri=gcs_input_uri, mime_type=mime_type)
-    gcs_documents = docai.GcsDocuments(documents=[gcs_document])
-    input_config = docai.BatchDocumentsInputConfig(gcs_documents=gcs_documents)
-    gcs_output_config = docai.DocumentOutputConfig.GcsOutputConfig(gcs_uri=gcs_output_uri,
-                                                                   field_mask=field_mask)
-    output_config = docai.DocumentOutputConfig(gcs_output_config=gcs_output_config)
+    print(f"Processing {file_url} online")
+    document = _process_content(client, name, content, mime_type, field_mask)
+    print("process document complete")
+
+    return document
+
+async def process_document_online_async(
+    project_id: str,
+    location: str,
+    processor_id: str,
+    mime_type: str,
+    file_url: str,
+    field_mask: Optional[str] = None,
+    processor_version_id: Optional[str] = None,
+    credentials: Optional[Credentials] = None
+):
+    """
+    Async version of process_document_online, on the async client
+
+    Returns:
+       Document
+    """
+    client = get_docai_async_client(location, credentials)
+    name = _processor_name(client, project_id, location, processor_id, processor_version_id)
+
+    content = await asyncio.to_thread(_read_file, file_url)
+
+    print(f"Processing {file_url} online")
+    document = await _process_content_async(client, name, content, mime_type, field_mask)
+    print("process document complete")
+
+    return document
+
+def _read_file(file_url: str):
+    with open(file_url, "rb") as f:
+        return f.read()
+
+def use_chunked_processing(file_url: str, mime_type: str):
+    """
+    Whether a local file should be split into page ranges and processed
+    with process_document_chunked (see DocAIConfig.fanout_enabled)
+
+    Args:
+        file_url: local file path
+        mime_type: file type of the file
+
+    Returns:
+        True if the file should be processed with process_document_chunked
+    """
+    if not DocAIConfig.fanout_enabled() or pypdf is None:
+        return False
+    if mime_type != "application/pdf":
+        return False
+
+    return count_pages(file_url, mime_type) > DocAIConfig.chunk_pages()
+
+def split_pdf(file_url: str, pages_per_chunk: int):
+    """
+    Split a local pdf into page range chunks
+
+    Args:
+        file_url: local file path of the pdf
+        pages_per_chunk: max number of pages in a chunk
+
+    Returns:
+        list of (first page index, pdf bytes) tuples in page order
+    """
+    reader = pypdf.PdfReader(file_url)
+    chunks = []
+
+    for start in range(0, len(reader.pages), pages_per_chunk):
+        writer = pypdf.PdfWriter()
+        for page in reader.pages[start:start + pages_per_chunk]:
+            writer.add_page(page)
+
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        chunks.append((start, buffer.getvalue()))
+
+    return chunks
+
+def process_document_chunked(
+    project_id: str,
+    location: str,
+    processor_id: str,
+    mime_type: str,
+    file_url: str,
+    field_mask: Optional[str] = None,
+    processor_version_id: Optional[str] = None,
+    credentials: Optional[Credentials] = None,
+    pages_per_chunk: Optional[int] = None,
+    max_concurrency: Optional[int] = None
+):
+    """
+    Split a large pdf into page ranges, process the chunks online as
+    concurrent requests and merge them back into a single Document, so
+    wall clock time scales with the number of chunks rather than pages
+
+    Args:
+        project_id: project id where processor is created
+        location: location of the processor (us, global, etc)
+        processor_id: id of the parser
+        mime_type: file type that is being processed
+        file_url: local file path of the pdf to be processed
+        field_mask: Optional. list of fields that a request should return
+        processor_version_id: Optional. set to specify particular version of a model
+        credentials: Optional. credentials to run as
+        pages_per_chunk: Optional. pages per request (see DocAIConfig.chunk_pages)
+        max_concurrency: Optional. max requests in flight (see DocAIConfig.max_concurrent_requests)
+
+    Returns:
+       Document
+    """
+    if pages_per_chunk is None:
+        pages_per_chunk = DocAIConfig.chunk_pages()
+    if max_concurrency is None:
+        max_concurrency = DocAIConfig.max_concurrent_requests()
+
+    client = get_docai_client(location, credentials)
+    name = _processor_name(client, project_id, location, processor_id, processor_version_id)
+
+    chunks = split_pdf(file_url, pages_per_chunk)
+    print(f"Processing {file_url} online in {len(chunks)} chunks of {pages_per_chunk} pages")
+
+    def process(chunk):
+        start, content = chunk
+        return start, _process_content(client, name, content, mime_type, field_mask)
+
+    # keep the number of requests in flight under the processor quota
+    workers = max(1, min(max_concurrency, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(process, chunks))
+
+    print("process document complete")
+
+    return merge_documents(results)
+
+async def process_document_chunked_async(
+    project_id: str,
+    location: str,
+    processor_id: str,
+    mime_type: str,
+    file_url: str,
+    field_mask: Optional[str] = None,
+    processor_version_id: Optional[str] = None,
+    credentials: Optional[Credentials] = None,
+    pages_per_chunk: Optional[int] = None,
+    max_concurrency: Optional[int] = None
+):
+    """
+    Async version of process_document_chunked; the chunks are concurrent
+    requests on the async client rather than threads
+
+    Returns:
+       Document
+    """
+    if pages_per_chunk is None:
+        pages_per_chunk = DocAIConfig.chunk_pages()
+    if max_concurrency is None:
+        max_concurrency = DocAIConfig.max_concurrent_requests()
+
+    client = get_docai_async_client(location, credentials)
+    name = _processor_name(client, project_id, location, processor_id, processor_version_id)
+
+    chunks = await asyncio.to_thread(split_pdf, file_url, pages_per_chunk)
+    print(f"Processing {file_url} online in {len(chunks)} chunks of {pages_per_chunk} pages")
+
+    # keep the number of requests in flight under the processor quota
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def process(chunk):
+        start, content = chunk
+        async with semaphore:
+            return start, await _process_content_async(client, name, content, mime_type, field_mask)
+
+    results = await asyncio.gather(*[process(chunk) for chunk in chunks])
+
+    print("process document complete")
+
+    return await asyncio.to_thread(merge_documents, results)
+
+def merge_documents(chunks: list):
+    """
+    Merge documents processed from consecutive page ranges into one.
+    Text is concatenated in order, and the page numbers, page anchors and
+    text anchors of each chunk's entities and pages (every page layout
+    element, including table cells and form fields) are shifted to their
+    position in the whole document. Only entities, pages and text are merged
+
+    Args:
+        chunks: list of (first page index, Document) tuples in page order
+
+    Returns:
+        Document
+    """
+    merged = docai.Document()
+    texts = []
+    text_offset = 0
+
+    for page_offset, document in chunks:
+        for entity in document.entities:
+            _shift_entity(entity, text_offset, page_offset)
+        for page in document.pages:
+            page.page_number += page_offset
+            _shift_page(page, text_offset)
+
+        merged.entities.extend(document.entities)
+        merged.pages.extend(document.pages)
+        if not merged.mime_type:
+            merged.mime_type = document.mime_type
+
+        texts.append(document.text)
+        text_offset += len(document.text)
+
+    merged.text = "".join(texts)
+
+    return merged
+
+def _shift_anchor(text_anchor, text_offset: int):
+    for segment in text_anchor.text_segments:
+        segment.start_index += text_offset
+        segment.end_index += text_offset
+
+def _shift_entity(entity, text_offset: int, page_offset: int):
+    _shift_anchor(entity.text_anchor, text_offset)
+    for page_ref in entity.page_anchor.page_refs:
+        # page refs are 0-based page indexes
+        page_ref.page += page_offset
+    for prop in entity.properties:
+        _shift_entity(prop, text_offset, page_offset)
+
+def _shift_page(page, text_offset: int):
+    _shift_anchor(page.layout.text_anchor, text_offset)
+    for elements in (page.blocks, page.paragraphs, page.lines, page.tokens, page.symbols,
+                     page.visual_elements, page.detected_barcodes, page.tables):
+        for element in elements:
+            _shift_anchor(element.layout.text_anchor, text_offset)
+    for table in page.tables:
+        for row in (*table.header_rows, *table.body_rows):
+            for cell in row.cells:
+                _shift_anchor(cell.layout.text_anchor, text_offset)
+    for field in page.form_fields:
+        _shift_anchor(field.field_name.text_anchor, text_offset)
+        _shift_anchor(field.field_value.text_anchor, text_offset)
+
+def _process_content(client: docai.DocumentProcessorServiceClient,
+                     name: str,
+                     content: bytes,
+                     mime_type: str,
+                     field_mask: Optional[str] = None):
+    # Configure and make the online process request
+    raw_document = docai.RawDocument(content=content, mime_type=mime_type)
+    request = docai.ProcessRequest(name=name,
+                                   raw_document=raw_document,
+                                   field_mask=field_mask)
+
+    # rate limited per project and location, retrying quota errors
+    _, project_id, _, location = name.split("/")[:4]
+    return call_with_retry("documentai", project_id, location,
+                           lambda: client.process_document(request=request)).document
 
+async def _process_content_async(client: docai.DocumentProcessorServiceAsyncClient,
+                                 name: str,
+                                 content: bytes,
+                                 mime_type: str,
+                                 field_mask: Optional[str] = None):
+    raw_document = docai.RawDocument(content=content, mime_type=mime_type)
+    request = docai.ProcessRequest(name=name,
+                                   raw_document=raw_document,
+                                   field_mask=field_mask)
+
+    _, project_id, _, location = name.split("/")[:4]
+    response = await call_with_retry_async("documentai", project_id, location,
+                                           lambda: client.process_document(request=request))
+    return response.document
+
+def document_output_shard(document: docai.Document, uri: str = ""):
+    """
+    Convert a processed Document into the same OutputShard that
+    storage.iter_output_shards yields for batch output
+
+    Args:
+        document: Document returned by process_document_online or process_document_chunked
+        uri: Optional. where the document came from
+
+    Returns:
+        OutputShard
+    """
+    entities = document.entities
+
+    # the summarizer puts the summary in the normalized value of the first
+    # entity; a document merged from chunks has one such entity per chunk
+    summary = ""
+    if entities:
+        summary_type = entities[0].type_
+        summary = "\n".join(entity.normalized_value.text for entity in entities
+                            if entity.type_ == summary_type)
+
+    return OutputShard(
+        uri=uri,
+        summary=summary,
+        text=document.text,
+        entities=[{'type': entity.type_, 'mentionText': entity.mention_text}
+                  for entity in entities])
+
+def extract_from_summary_document(document: docai.Document, uri: str = ""):
+    """
+    Same as storage.extract_from_summary_output, for an online processed Document
+
+    Returns:
+        json_uri: uri of the document
+        summary: summary of the processor results
+        full_text: the full OCR text from the parser
+    """
+    json_uri, summary, entities, full_text = collect_output([document_output_shard(document, uri)])
+    return json_uri, summary, full_text
+
+def extract_from_contract_document(document: docai.Document, uri: str = ""):
+    """
+    Same as storage.extract_from_contract_output, for an online processed Document
+
+    Returns:
+        json_uri: uri of the document
+        entities: list of key value pair of extracted entities
+        full_text: the full OCR text from the parser
+    """
+    json_uri, summary, entities, full_text = collect_output([document_output_shard(document, uri)])
+    return json_uri, entities, full_text
+
+def _processor_name(client: docai.DocumentProcessorServiceClient,
+                    project_id: str,
+                    location: str,
+                    processor_id: str,
+                    processor_version_id: Optional[str] = None):
     if processor_version_id:
         # The full resource name of the processor version, e.g.:
         # `projects/{project_id}/locations/{location}/processors/{processor_id}/processorVersions/{processor_version_id}`
-        name = client.processor_version_path(project_id, 
+        return client.processor_version_path(project_id, 
                                              location, 
                                              processor_id, 
                                              processor_version_id)
-    else:
-        # The full resource name of the processor, e.g.:
-        # `projects/{project_id}/locations/{location}/processors/{processor_id}`
-        name = client.processor_path(project_id, location, processor_id)
+
+    # The full resource name of the processor, e.g.:
+    # `projects/{project_id}/locations/{location}/processors/{processor_id}`
+    return client.processor_path(project_id, location, processor_id)
+
+def start_batch_process(
+    project_id: str,
+    location: str,
+    processor_id: str,
+    mime_type: str,
+    gcs_input_uri: str | list,
+    gcs_output_uri: str,
+    field_mask: Optional[str] = None,
+    processor_version_id: Optional[str] = None,
+    credentials: Optional[Credentials] = None
+):
+    """
+    Submit a batch process request to the document AI processor without
+    waiting for it to finish. Use track_operation (or operation.result())
+    to wait for the returned operation
+
+    Args:
+        project_id: project id where processor is created
+        location: location of the processor (us, global, etc)
+        processor_id: id of the parser
+        mime_type: file type that is being processed
+        gcs_input_uri: the cloud storage URI of the file (or list of files) to be processed
+        gcs_output_uri: the cloud storage URI of the folder where output gets sent
+        field_mask: Optional. list of fields that a request should return
+        processor_version_id: Optional. set to specify particular version of a model
+        credentials: Optional. credentials to run as
+
+    Returns:
+       google.api_core.operation.Operation
+    """
+    # shared client for the location; if no credentials, will use
+    # the default application credentials
+    client = get_docai_client(location, credentials)
+    request = _batch_request(client, project_id, location, processor_id, mime_type,
+                             gcs_input_uri, gcs_output_uri, field_mask, processor_version_id)
+
+    # Make the batch process request; rate limited, retrying quota errors
+    return call_with_retry("documentai", project_id, location,
+                           lambda: client.batch_process_documents(request))
+
+async def start_batch_process_async(
+    project_id: str,
+    location: str,
+    processor_id: str,
+    mime_type: str,
+    gcs_input_uri: str | list,
+    gcs_output_uri: str,
+    field_mask: Optional[str] = None,
+    processor_version_id: Optional[str] = None,
+    credentials: Optional[Credentials] = None
+):
+    """
+    Async version of start_batch_process, on the async client
+
+    Returns:
+       google.api_core.operation_async.AsyncOperation
+    """
+    client = get_docai_async_client(location, credentials)
+    request = _batch_request(client, project_id, location, processor_id, mime_type,
+                             gcs_input_uri, gcs_output_uri, field_mask, processor_version_id)
+
+    return await call_with_retry_async("documentai", project_id, location,
+                                       lambda: client.batch_process_documents(request))
+
+def _batch_request(client, project_id, location, processor_id, mime_type,
+                   gcs_input_uri, gcs_output_uri, field_mask, processor_version_id):
+    # a single batch can process many documents
+    gcs_input_uris = [gcs_input_uri] if isinstance(gcs_input_uri, str) else gcs_input_uri
+    gcs_documents = docai.GcsDocuments(documents=[
+        docai.GcsDocument(gcs_uri=uri, mime_type=mime_type) for uri in gcs_input_uris])
+    input_config = docai.BatchDocumentsInputConfig(gcs_documents=gcs_documents)
+    gcs_output_config = docai.DocumentOutputConfig.GcsOutputConfig(gcs_uri=gcs_output_uri,
+                                                                   field_mask=field_mask)
+    output_config = docai.DocumentOutputConfig(gcs_output_config=gcs_output_config)
+
+    name = _processor_name(client, project_id, location, processor_id, processor_version_id)
         
     # Configure the batch process request
-    request = docai.BatchProcessRequest(name=name, 
-                                        input_documents=input_config,
-                                        document_output_config=output_config)
+    return docai.BatchProcessRequest(name=name, 
+                                     input_documents=input_config,
+                                     document_output_config=output_config)
+
+async def track_operation(operation, poll_interval: Optional[float] = None):
+    """
+    Poll a batch process operation without blocking the event loop (or a
+    worker thread) while the job runs
+
+    Args:
+        operation: operation returned by start_batch_process
+        poll_interval: Optional. seconds between polls (see DocAIConfig.poll_interval)
+
+    Yields:
+        BatchProcessMetadata on every poll. The last one yielded is the
+        final metadata of the finished operation
+
+    Raises:
+        ValueError: if the batch process did not succeed
+    """
+    if poll_interval is None:
+        poll_interval = DocAIConfig.poll_interval()
+
+    while not await _operation_done(operation):
+        if operation.metadata is not None:
+            yield docai.BatchProcessMetadata(operation.metadata)
+        await asyncio.sleep(poll_interval)
+
+    yield _final_metadata(operation)
+
+async def _operation_done(operation):
+    if isinstance(operation, operation_async.AsyncOperation):
+        return await operation.done()
+    # operation.done() refreshes the operation with a blocking rpc
+    return await asyncio.to_thread(operation.done)
+
+def process_document(
+    project_id: str,
+    location: str,
+    processor_id: str,
+    mime_type: str,
+    gcs_input_uri: str | list,
+    gcs_output_uri: str,
+    field_mask: Optional[str] = None,
+    processor_version_id: Optional[str] = None,
+    credentials: Optional[Credentials] = None
+):
+    """
+    Send a batch process request to the document AI processor and wait
+    for it to complete
 
-    # Make the batch process request
-    operation = client.batch_process_documents(request)
+    Args:
+        project_id: project id where processor is created
+        location: location of the processor (us, global, etc)
+        processor_id: id of the parser
+        mime_type: file type that is being processed
+        gcs_input_uri: the cloud storage URI of the file (or list of files) to be processed
+        gcs_output_uri: the cloud storage URI of the folder where output gets sent
+        field_mask: Optional. list of fields that a request should return
+        processor_version_id: Optional. set to specify particular version of a model
+        credentials: Optional. credentials to run as
+
+    Returns:
+       BatchProcessMetadata 
+
+    Concurrent identical requests (e.g. the same file from several sessions)
+    share one operation and all get its metadata
+    """
+    key = _batch_key(project_id, location, processor_id, mime_type, gcs_input_uri,
+                     gcs_output_uri, field_mask, processor_version_id, credentials)
+
+    return _batch_flight.do(key, _process_document,
+                            project_id, location, processor_id, mime_type, gcs_input_uri,
+                            gcs_output_uri, field_mask, processor_version_id, credentials)
+
+async def process_document_async(
+    project_id: str,
+    location: str,
+    processor_id: str,
+    mime_type: str,
+    gcs_input_uri: str | list,
+    gcs_output_uri: str,
+    field_mask: Optional[str] = None,
+    processor_version_id: Optional[str] = None,
+    credentials: Optional[Credentials] = None
+):
+    """
+    Async version of process_document; the operation is polled without
+    holding a thread
+
+    Returns:
+       BatchProcessMetadata 
+    """
+    key = _batch_key(project_id, location, processor_id, mime_type, gcs_input_uri,
+                     gcs_output_uri, field_mask, processor_version_id, credentials)
+
+    async def run():
+        operation = await start_batch_process_async(
+            project_id=project_id,
+            location=location,
+            processor_id=processor_id,
+            mime_type=mime_type,
+            gcs_input_uri=gcs_input_uri,
+            gcs_output_uri=gcs_output_uri,
+            field_mask=field_mask,
+            processor_version_id=processor_version_id,
+            credentials=credentials
+        )
+
+        print("Waiting for operation to complete...")
+        async for metadata in track_operation(operation):
+            pass
+        return metadata
+
+    return await _batch_flight.do_async(key, run)
+
+def _batch_key(project_id, location, processor_id, mime_type, gcs_input_uri,
+               gcs_output_uri, field_mask, processor_version_id, credentials):
+    inputs = (gcs_input_uri,) if isinstance(gcs_input_uri, str) else tuple(gcs_input_uri)
+    return (project_id, location, processor_id, processor_version_id, mime_type,
+            inputs, gcs_output_uri, field_mask, credentials_key(credentials))
+
+def _process_document(project_id, location, processor_id, mime_type, gcs_input_uri,
+                      gcs_output_uri, field_mask, processor_version_id, credentials):
+    operation = start_batch_process(
+        project_id=project_id,
+        location=location,
+        processor_id=processor_id,
+        mime_type=mime_type,
+        gcs_input_uri=gcs_input_uri,
+        gcs_output_uri=gcs_output_uri,
+        field_mask=field_mask,
+        processor_version_id=processor_version_id,
+        credentials=credentials
+    )
 
     try:
         print("Waiting for operation to complete...")
@@ -77,6 +675,22 @@ def process_document(
     except (RetryError, InternalServerError) as e:
         print(e.message)
 
+    return _final_metadata(operation)
+
+def output_destinations(metadata: docai.BatchProcessMetadata):
+    """
+    Map each input document of a batch process to its output folder
+
+    Args:
+        metadata: final BatchProcessMetadata of the operation
+
+    Returns:
+        dict of input gcs uri to output gcs uri
+    """
+    return {status.input_gcs_source: status.output_gcs_destination
+            for status in metadata.individual_process_statuses}
+
+def _final_metadata(operation):
     # Once the operation is complete,
     # get output document information from operation metadata
     metadata = docai.BatchProcessMetadata(operation.metadata)
@@ -86,4 +700,4 @@ def process_document(
 
     print("process document complete")
     
-    return metadata
\ No newline at end of file
+    return metadata
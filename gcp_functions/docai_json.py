@@ -0,0 +1,136 @@
+import json
+import re
+from typing import IO, Optional
+
+# optional faster JSON backends; fall back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_CAMEL = re.compile(r"_([a-z])")
+
+
+def loads(content: bytes):
+    """
+    Parse a whole JSON document, using orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def parse_field_mask(field_mask: Optional[str]):
+    """
+    Convert a field mask (e.g. "text,entities,pages.pageNumber") into a list
+    of key paths. snake_case names are converted to the camelCase keys used
+    in the docai output json
+
+    Args:
+        field_mask: comma separated list of fields, or None for all fields
+
+    Returns:
+        list of tuples of keys, or None if every field is wanted
+    """
+    if not field_mask:
+        return None
+
+    paths = []
+    for field in field_mask.split(","):
+        field = field.strip()
+        if field:
+            keys = tuple(_CAMEL.sub(lambda m: m.group(1).upper(), key) for key in field.split("."))
+            paths.append(keys)
+
+    return paths or None
+
+
+def _wanted(path: tuple, masks: list):
+    # a key is wanted if it is inside a masked field or on the way to one
+    for mask in masks:
+        n = min(len(path), len(mask))
+        if path[:n] == mask[:n]:
+            return True
+    return False
+
+
+def _prune(value, masks: list, path: tuple = ()):
+    # apply the field mask to an already parsed document
+    if isinstance(value, dict):
+        return {k: _prune(v, masks, path + (k,)) for k, v in value.items() if _wanted(path + (k,), masks)}
+    if isinstance(value, list):
+        return [_prune(v, masks, path) for v in value]
+    return value
+
+
+def select_fields(doc: dict, field_mask: Optional[str]):
+    """
+    Drop everything from a parsed docai document that is not in the field mask
+    """
+    masks = parse_field_mask(field_mask)
+    if masks is None:
+        return doc
+    return _prune(doc, masks)
+
+
+def load_stream(stream: IO[bytes], field_mask: Optional[str] = None):
+    """
+    Parse a docai output json from a binary stream, only building the
+    fields selected by the field mask. Subtrees outside the mask (page
+    layouts, tokens, bounding boxes, ...) are skipped as they stream past,
+    so they are never materialised as python objects
+
+    Falls back to reading the whole stream if ijson is not installed
+
+    Args:
+        stream: file-like object opened in binary mode
+        field_mask: Optional. comma separated list of fields to keep
+
+    Returns:
+        dict of the selected fields
+    """
+    masks = parse_field_mask(field_mask)
+
+    if ijson is None or masks is None:
+        return select_fields(loads(stream.read()), field_mask)
+
+    builder = ijson.ObjectBuilder()
+    decisions = {}
+    skip_depth = 0
+    skip_next = False
+
+    # ijson picks its fastest available backend (yajl2_c if compiled)
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if skip_depth:
+            if event == "start_map" or event == "start_array":
+                skip_depth += 1
+            elif event == "end_map" or event == "end_array":
+                skip_depth -= 1
+            continue
+
+        if skip_next:
+            # first event of the value of an unwanted key
+            skip_next = False
+            if event == "start_map" or event == "start_array":
+                skip_depth = 1
+            continue
+
+        if event == "map_key":
+            key = (prefix, value)
+            wanted = decisions.get(key)
+            if wanted is None:
+                # array items share their parent's path, so drop "item"
+                path = tuple(k for k in prefix.split(".") if k and k != "item") + (value,)
+                wanted = decisions[key] = _wanted(path, masks)
+            if not wanted:
+                skip_next = True
+                continue
+
+        builder.event(event, value)
+
+    return builder.value
@@ -1,41 +1,413 @@
-import vertexai.generative_models as generative_models
-from vertexai.generative_models import GenerativeModel, GenerationConfig, Part
-from .config import GeminiConfig
+import asyncio
+import functools
+import hashlib
+import itertools
+import time
+from google.api_core.exceptions import NotFound
+from .config import GeminiConfig, AnswerCacheConfig
+from .clients import get_generative_model, get_async_generative_model
+from .retrieval import select_context
+from .prompt import build_docqa_prompt, _turns
+from .context_cache import get_context_cache
+from .cache import get_answer_cache, normalize_query
+from .singleflight import SingleFlight
+from .hedging import Hedger
+from .ratelimit import call_with_retry, call_with_retry_async, _left
+from .lazy import lazy_import
 
-def gemini_docqa_response(message, history, ground_text):
+generative_models = lazy_import("vertexai.generative_models")
+initializer = lazy_import("google.cloud.aiplatform.initializer")
+
+# identical questions asked at the same time share one model call
+_docqa_flight = SingleFlight("gemini docqa")
+
+# deadlines and hedging of model calls; streams are timed to their first chunk
+_docqa_hedger = Hedger("gemini docqa")
+_stream_hedger = Hedger("gemini docqa first chunk")
+
+def _generation_config():
+    return generative_models.GenerationConfig(
+        # Only one candidate for now.
+        candidate_count=1,
+        temperature=GeminiConfig.temperature(),
+        top_p=GeminiConfig.top_p(),
+        top_k=GeminiConfig.top_k())
+
+def _answer_key(message, history, ground_text):
+    """
+    Answer cache key of a question, or None if the answer should not be cached:
+    the cache is disabled, the temperature is above
+    AnswerCacheConfig.max_temperature(), or the question is a follow up whose
+    answer may depend on the conversation (see AnswerCacheConfig.with_history).
+    Follow ups are keyed on the conversation too, so they are only reused
+    within the same conversation
+    """
+    if get_answer_cache() is None:
+        return None
+    if GeminiConfig.temperature() > AnswerCacheConfig.max_temperature():
+        return None
+    if history and not AnswerCacheConfig.with_history():
+        return None
+
+    doc_hash = hashlib.sha256(ground_text.encode("utf-8")).hexdigest()
+    key = f"{doc_hash}:{GeminiConfig.model()}:{_generation_key()}:{normalize_query(message)}"
+    if history:
+        key = f"{key}:{_history_digest(history)}"
+    return key
+
+def _history_digest(history):
+    # digest of the turns the prompt's history is built from (see prompt._format_history)
+    digest = hashlib.sha256()
+    for user, assistant in _turns(history):
+        digest.update(f"{len(user)}:{user}{len(assistant)}:{assistant}".encode("utf-8"))
+    return digest.hexdigest()
+
+def _cached_answer(key):
+    if key is None:
+        return None
+    answer = get_answer_cache().get(key)
+    if answer is not None:
+        print(f"Answer cache hit {get_answer_cache().stats()}")
+    return answer
+
+def _generation_key():
+    return f"{GeminiConfig.temperature()}:{GeminiConfig.top_p()}:{GeminiConfig.top_k()}"
+
+def _flight_key(context, cached, ground_text):
+    """
+    Key of an exact model request; requests with the same key are coalesced
+    """
+    request = f"{GeminiConfig.model()}:{_generation_key()}:{cached}\n{context}"
+    if cached:
+        # the document is not in the prompt of a cached context request
+        request = f"{hashlib.sha256(ground_text.encode('utf-8')).hexdigest()}:{request}"
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+@functools.lru_cache(maxsize=1)
+def _quota_scope():
+    """
+    (project, location) the model calls are made in; quota is per project and
+    location. Looked up once, since finding the default project can be slow
+    """
+    try:
+        project = initializer.global_config.project
+    except Exception:
+        project = "default"
+    return project, initializer.global_config.location
+
+def _limited(fn, end=None):
+    # rate limited, retrying quota errors with backoff until end (time.monotonic)
+    return call_with_retry("gemini", *_quota_scope(), fn, deadline=_left(end))
+
+async def _limited_async(fn, end=None):
+    # the first lookup of the project can block; keep it off the event loop
+    scope = await asyncio.to_thread(_quota_scope)
+    return await call_with_retry_async("gemini", *scope, fn, deadline=_left(end))
+
+def _deadline_end():
+    # end (time.monotonic) of the model call's deadline, or None
+    deadline = GeminiConfig.timeout_seconds() or None
+    return time.monotonic() + deadline if deadline else None
+
+def _generate_content(model, contents, config, timeout=None):
+    """
+    model.generate_content with an rpc timeout, which the sdk doesn't take:
+    the same request is made on the model's prediction client. A call the
+    hedger stopped waiting for then ends at its deadline instead of holding
+    a pool thread and a limiter slot
+    """
+    if timeout is None:
+        return model.generate_content(contents, generation_config=config)
+    request = model._prepare_request(contents=contents, generation_config=config)
+    return model._parse_response(model._prediction_client.generate_content(request=request, timeout=timeout))
+
+async def _generate_content_async(model, contents, config, timeout=None):
+    """
+    Async version of _generate_content
+    """
+    if timeout is None:
+        return await model.generate_content_async(contents, generation_config=config)
+    request = model._prepare_request(contents=contents, generation_config=config)
+    response = await model._prediction_async_client.generate_content(request=request, timeout=timeout)
+    return model._parse_response(response)
+
+def _generate_text(model, context, config):
+    end = _deadline_end()
+    return _docqa_hedger.call(
+        lambda: _limited(lambda: _generate_content(model, context, config, _left(end)).text, end),
+        deadline=GeminiConfig.timeout_seconds() or None,
+        hedge=GeminiConfig.hedge())
+
+def _text_chunks(stream):
+    for chunk in stream:
+        try:
+            text = chunk.text
+        except ValueError:
+            # chunk without text, e.g. only a finish reason
+            continue
+        yield text
+
+def _open_stream(model, context, config):
+    # start a stream and wait for its first piece of text
+    chunks = _text_chunks(model.generate_content(context, generation_config=config, stream=True))
+    return next(chunks, None), chunks
+
+def _stream_text(model, context, config):
+    # the deadline is for the first chunk, so it only bounds the waits and
+    # retries; as an rpc timeout it would cut long answers short
+    end = _deadline_end()
+    first, chunks = _stream_hedger.call(lambda: _limited(lambda: _open_stream(model, context, config), end),
+                                        deadline=GeminiConfig.timeout_seconds() or None,
+                                        hedge=GeminiConfig.hedge(),
+                                        discard=lambda opened: opened[1].close())
+    if first is None:
+        return
+    yield first
+    yield from chunks
+
+async def _generate_text_async(model, context, config):
+    end = _deadline_end()
+
+    async def generate():
+        response = await _generate_content_async(model, context, config, _left(end))
+        return response.text
+
+    return await _docqa_hedger.call_async(lambda: _limited_async(generate, end),
+                                          deadline=GeminiConfig.timeout_seconds() or None,
+                                          hedge=GeminiConfig.hedge())
+
+async def _text_chunks_async(stream):
+    async for chunk in stream:
+        try:
+            text = chunk.text
+        except ValueError:
+            # chunk without text, e.g. only a finish reason
+            continue
+        yield text
+
+async def _open_stream_async(model, context, config):
+    # start a stream and wait for its first piece of text
+    stream = await model.generate_content_async(context, generation_config=config, stream=True)
+    chunks = _text_chunks_async(stream)
+    return await anext(chunks, None), chunks
+
+async def _stream_text_async(model, context, config):
+    end = _deadline_end()
+    first, chunks = await _stream_hedger.call_async(
+        lambda: _limited_async(lambda: _open_stream_async(model, context, config), end),
+        deadline=GeminiConfig.timeout_seconds() or None,
+        hedge=GeminiConfig.hedge(),
+        discard=lambda opened: asyncio.ensure_future(opened[1].aclose()))
+    if first is None:
+        return
+    yield first
+    async for text in chunks:
+        yield text
+
+def _docqa_request(message, history, ground_text, model=None, use_context_cache=True):
+    """
+    Model and prompt for a document QA question. Uses the document's cached
+    context when it qualifies, otherwise sends the grounding text (or the
+    passages relevant to the question for large documents) in the prompt
+
+    Args:
+        model: Optional. model to use when there is no cached context;
+            defaults to the shared model (see clients.get_generative_model)
+        use_context_cache: set to False to build the prompt without a cached context
+
+    Returns:
+        model: the model to generate with
+        prompt: prompt text
+        cached: whether the model uses a cached context
+    """
+    model_name = GeminiConfig.model()
+
+    cached_model = get_context_cache().get_model(ground_text, model_name) if use_context_cache else None
+    if cached_model is not None:
+        return cached_model, build_docqa_prompt(message, history, None), True
+
+    # only the passages relevant to the question for large documents, and
+    # recent chat history, within the prompt token budget
+    model = model or get_generative_model(model_name)
+    context = build_docqa_prompt(message, history, select_context(ground_text, message), model=model)
+
+    return model, context, False
+
+def _drop_cached_context(error, cached, ground_text):
+    """
+    Handle a NotFound from a docqa request: if the request used a cached
+    context, the context is gone (e.g. expired) and is forgotten, and the
+    caller retries with use_context_cache=False rather than creating
+    another one; the next question creates a new one. Otherwise re-raise
+    """
+    if not cached:
+        raise error
+    get_context_cache().invalidate(ground_text, GeminiConfig.model())
+
+def gemini_docqa_response(message, history, ground_text, use_context_cache=True):
     """
     Function to handle the document Q&A interaction
 
     Args:
         message: the question to send to the LLM
-        history: full context of chat history (Not currently used)
-        ground_text: text to use as context for the prompt
+        history: chat history; recent turns are included in the prompt
+        ground_text: text to use as context for the prompt; large documents
+            are narrowed down to the passages most relevant to the question,
+            or held in a Vertex AI cached context when the model supports it
+        use_context_cache: set to False to send the prompt without a cached
+            context (see gcp_functions.context_cache)
+
+    The prompt is kept within GeminiConfig.max_prompt_tokens(). Answers are
+    reused for the same question on the same document (see AnswerCacheConfig),
+    and identical requests from several sessions at once share one model call.
+    The call gives up after GeminiConfig.timeout_seconds(), and can be hedged
+    when slow (see GeminiConfig.hedge)
     """
-    model_name = GeminiConfig.model()
-    temp = GeminiConfig.temperature()
-    p = GeminiConfig.top_p()
-    k = GeminiConfig.top_k()
+    key = _answer_key(message, history, ground_text)
+    answer = _cached_answer(key)
+    if answer is not None:
+        return answer
 
-    model = GenerativeModel(model_name)
-    config = GenerationConfig(
-        # Only one candidate for now.
-        candidate_count=1,
-        temperature=temp,
-        top_p=p,
-        top_k=k)
+    config = _generation_config()
+    model, context, cached = _docqa_request(message, history, ground_text, use_context_cache=use_context_cache)
+
+    try:
+        answer = _docqa_flight.do(_flight_key(context, cached, ground_text),
+                                  _generate_text, model, context, config)
+    except NotFound as e:
+        _drop_cached_context(e, cached, ground_text)
+        return gemini_docqa_response(message, history, ground_text, use_context_cache=False)
+
+    if key is not None:
+        get_answer_cache().put(key, answer)
+
+    return answer
+
+async def gemini_docqa_response_async(message, history, ground_text, use_context_cache=True):
+    """
+    Async version of gemini_docqa_response, on the model's async api. Shares
+    the answer cache and in-flight calls with gemini_docqa_response
+    """
+    key = _answer_key(message, history, ground_text)
+    answer = _cached_answer(key)
+    if answer is not None:
+        return answer
+
+    config = _generation_config()
+    model, context, cached = await asyncio.to_thread(
+        _docqa_request, message, history, ground_text, get_async_generative_model(GeminiConfig.model()),
+        use_context_cache)
+
+    try:
+        answer = await _docqa_flight.do_async(_flight_key(context, cached, ground_text),
+                                              _generate_text_async, model, context, config)
+    except NotFound as e:
+        _drop_cached_context(e, cached, ground_text)
+        return await gemini_docqa_response_async(message, history, ground_text, use_context_cache=False)
+
+    if key is not None:
+        get_answer_cache().put(key, answer)
+
+    return answer
+
+def gemini_docqa_response_stream(message, history, ground_text, use_context_cache=True):
+    """
+    Streaming version of gemini_docqa_response; yields the answer in
+    pieces as the model generates it instead of waiting for the whole
+    response. Sessions asking the identical question at the same time all
+    receive the chunks of one shared stream. The deadline and hedging apply
+    to the first chunk
+
+    Args:
+        message: the question to send to the LLM
+        history: chat history; recent turns are included in the prompt
+        ground_text: text to use as context for the prompt; large documents
+            are narrowed down to the passages most relevant to the question,
+            or held in a Vertex AI cached context when the model supports it
+        use_context_cache: set to False to send the prompt without a cached context
+
+    Yields:
+        text chunks of the answer; a cached answer is yielded whole
+    """
+    key = _answer_key(message, history, ground_text)
+    answer = _cached_answer(key)
+    if answer is not None:
+        yield answer
+        return
 
-    context = f"""
-    Answer any questions using only data from the context below:\n
+    config = _generation_config()
+    model, context, cached = _docqa_request(message, history, ground_text, use_context_cache=use_context_cache)
 
-    {ground_text}
-    
-    Do not answer any questions where you do not have context for.
-    
-    Question: {message}
+    start = time.perf_counter()
+    stream = _docqa_flight.stream(_flight_key(context, cached, ground_text),
+                                  _stream_text, model, context, config)
+    try:
+        chunks = [next(stream, None)]
+    except NotFound as e:
+        _drop_cached_context(e, cached, ground_text)
+        yield from gemini_docqa_response_stream(message, history, ground_text, use_context_cache=False)
+        return
+
+    first = True
+    answer = []
+    for text in itertools.chain(chunks, stream):
+        if text is None:
+            break
+
+        if first:
+            print(f"Gemini time to first token: {time.perf_counter() - start:.2f}s")
+            first = False
+        answer.append(text)
+        yield text
+
+    print(f"Gemini response complete in {time.perf_counter() - start:.2f}s")
+
+    # only complete answers are cached; a stream closed early never gets here
+    if key is not None and answer:
+        get_answer_cache().put(key, "".join(answer))
+
+async def gemini_docqa_response_stream_async(message, history, ground_text, use_context_cache=True):
+    """
+    Async version of gemini_docqa_response_stream, on the model's async api
+
+    Yields:
+        text chunks of the answer; a cached answer is yielded whole
     """
-    resp = model.generate_content(context, generation_config=config)
+    key = _answer_key(message, history, ground_text)
+    answer = _cached_answer(key)
+    if answer is not None:
+        yield answer
+        return
+
+    config = _generation_config()
+    model, context, cached = await asyncio.to_thread(
+        _docqa_request, message, history, ground_text, get_async_generative_model(GeminiConfig.model()),
+        use_context_cache)
+
+    start = time.perf_counter()
+    stream = _docqa_flight.stream_async(_flight_key(context, cached, ground_text),
+                                        _stream_text_async, model, context, config)
+    try:
+        text = await anext(stream, None)
+    except NotFound as e:
+        _drop_cached_context(e, cached, ground_text)
+        async for text in gemini_docqa_response_stream_async(message, history, ground_text, use_context_cache=False):
+            yield text
+        return
 
-    return resp.text
+    if text is not None:
+        print(f"Gemini time to first token: {time.perf_counter() - start:.2f}s")
+        answer = [text]
+        yield text
+        async for text in stream:
+            answer.append(text)
+            yield text
+
+    print(f"Gemini response complete in {time.perf_counter() - start:.2f}s")
+
+    # only complete answers are cached; a stream closed early never gets here
+    if key is not None and answer:
+        get_answer_cache().put(key, "".join(answer))
 
 
 
@@ -48,23 +420,27 @@ def gemini_audio_response(audio_uri, prompt):
         audio_uri: the gcs uri of the audio file
         prompt: the prompt to pass to the generative model
     """
-    model_name = GeminiConfig.model()
-    temp = GeminiConfig.temperature()
-    p = GeminiConfig.top_p()
-    k = GeminiConfig.top_k()
+    model = get_generative_model(GeminiConfig.model())
+    config = _generation_config()
 
-    model = GenerativeModel(model_name)
-    config = GenerationConfig(
-        # Only one candidate for now.
-        candidate_count=1,
-        temperature=temp,
-        top_p=p,
-        top_k=k)
-
-    audio_file = Part.from_uri(audio_uri, mime_type="audio/wav")
+    audio_file = generative_models.Part.from_uri(audio_uri, mime_type="audio/wav")
     contents = [audio_file, prompt]
 
-    response = model.generate_content(contents)
+    response = _limited(lambda: model.generate_content(contents))
 
     return response.text
 
+
+
+async def gemini_audio_response_async(audio_uri, prompt):
+    """
+    Async version of gemini_audio_response, on the model's async api
+    """
+    model = get_async_generative_model(GeminiConfig.model())
+
+    audio_file = generative_models.Part.from_uri(audio_uri, mime_type="audio/wav")
+    contents = [audio_file, prompt]
+
+    response = await _limited_async(lambda: model.generate_content_async(contents))
+
+    return response.text
@@ -0,0 +1,218 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Optional
+from google.api_core.exceptions import DeadlineExceeded
+from .config import HedgeConfig
+
+# calls are run on this pool so the caller can stop waiting on them
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+
+class Hedger:
+    """
+    Runs backend calls with a deadline and, optionally, hedging: if a call
+    has not returned after the recent p95 latency, a second identical call
+    is fired and whichever returns first is used. Latencies and how often
+    the hedge wins are tracked per Hedger
+
+    Args:
+        name: name used in log messages and stats
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self._latencies = deque(maxlen=HedgeConfig.window())
+        self._lock = threading.Lock()
+
+    def hedge_delay(self):
+        """
+        Seconds to wait before hedging, or None until there are enough
+        latency samples to tell what slow is
+        """
+        with self._lock:
+            if len(self._latencies) < HedgeConfig.min_samples():
+                return None
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * HedgeConfig.percentile() / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def call(self,
+             fn: Callable,
+             deadline: Optional[float] = None,
+             hedge: bool = False,
+             discard: Optional[Callable] = None):
+        """
+        Call fn() within the deadline
+
+        Args:
+            fn: the call to make; called twice when hedging, so it must be safe to repeat
+            deadline: Optional. seconds to wait for a result before raising DeadlineExceeded
+            hedge: whether to fire a second call when the first is slow
+            discard: Optional. called with the result of the losing call, e.g. to close it
+
+        Returns:
+            result of whichever call returned first
+        """
+        with self._lock:
+            self.calls += 1
+
+        start = time.perf_counter()
+        end = start + deadline if deadline else None
+        primary = _executor.submit(_timed, fn)
+        futures = [primary]
+
+        delay = self.hedge_delay() if hedge else None
+        if delay is not None:
+            done, _ = wait(futures, timeout=_remaining(end, delay))
+            if not done and (end is None or time.perf_counter() < end):
+                with self._lock:
+                    self.hedged += 1
+                futures.append(_executor.submit(_timed, fn))
+
+        error = None
+        pending = list(futures)
+        while pending:
+            done, _ = wait(pending, timeout=_remaining(end), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                pending.remove(future)
+                try:
+                    result, elapsed = future.result()
+                except Exception as e:
+                    # keep waiting on the other call, if any
+                    error = error or e
+                    continue
+
+                self._record(elapsed, future is not primary)
+                for other in pending:
+                    _abandon(other, discard)
+                return result
+
+        if error is not None and not pending:
+            raise error
+
+        for other in pending:
+            _abandon(other, discard)
+        with self._lock:
+            self.timeouts += 1
+        print(f"{self.name}: no response within {deadline}s {self.stats()}")
+        raise DeadlineExceeded(f"{self.name} did not respond within {deadline}s")
+
+    async def call_async(self,
+                         fn: Callable,
+                         deadline: Optional[float] = None,
+                         hedge: bool = False,
+                         discard: Optional[Callable] = None):
+        """
+        Async version of call; fn returns an awaitable. The losing call is
+        cancelled rather than left to finish
+        """
+        with self._lock:
+            self.calls += 1
+
+        start = time.perf_counter()
+        end = start + deadline if deadline else None
+        primary = asyncio.ensure_future(_timed_async(fn))
+        tasks = [primary]
+
+        delay = self.hedge_delay() if hedge else None
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=_remaining(end, delay))
+            if not done and (end is None or time.perf_counter() < end):
+                with self._lock:
+                    self.hedged += 1
+                tasks.append(asyncio.ensure_future(_timed_async(fn)))
+
+        error = None
+        pending = list(tasks)
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=_remaining(end), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    pending.remove(task)
+                    try:
+                        result, elapsed = task.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+
+                    self._record(elapsed, task is not primary)
+                    return result
+        finally:
+            for task in pending:
+                task.cancel()
+                if discard is not None:
+                    task.add_done_callback(lambda t: _discard_async(t, discard))
+
+        if error is not None and not pending:
+            raise error
+
+        with self._lock:
+            self.timeouts += 1
+        print(f"{self.name}: no response within {deadline}s {self.stats()}")
+        raise DeadlineExceeded(f"{self.name} did not respond within {deadline}s")
+
+    def _record(self, elapsed: float, hedge_won: bool):
+        with self._lock:
+            self._latencies.append(elapsed)
+            if hedge_won:
+                self.hedge_wins += 1
+        if hedge_won:
+            print(f"{self.name}: hedged request won {self.stats()}")
+
+    def stats(self):
+        """
+        Call, hedge and timeout counters
+        """
+        with self._lock:
+            return {"calls": self.calls,
+                    "hedged": self.hedged,
+                    "hedge_wins": self.hedge_wins,
+                    "timeouts": self.timeouts}
+
+
+def _timed(fn: Callable):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+async def _timed_async(fn: Callable):
+    start = time.perf_counter()
+    result = await fn()
+    return result, time.perf_counter() - start
+
+
+def _discard_async(task, discard: Callable):
+    # a cancelled call may still have completed just before the cancel
+    if not task.cancelled() and task.exception() is None:
+        discard(task.result()[0])
+
+
+def _remaining(end: Optional[float], cap: Optional[float] = None):
+    # seconds left until end, no more than cap; None means no limit
+    if end is None:
+        return cap
+    left = max(end - time.perf_counter(), 0)
+    return left if cap is None else min(left, cap)
+
+
+def _abandon(future, discard: Optional[Callable]):
+    # a call that already started can't be interrupted; clean up its result when it lands
+    if future.cancel() or discard is None:
+        return
+
+    def cleanup(f):
+        if not f.cancelled() and f.exception() is None:
+            discard(f.result()[0])
+
+    future.add_done_callback(cleanup)
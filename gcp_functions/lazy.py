@@ -0,0 +1,42 @@
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is only imported when one of its attributes
+    is first used. The GCP SDKs take seconds to import, which would
+    otherwise all be paid before the UI starts serving
+
+    Args:
+        name: full name of the module, e.g. "google.cloud.documentai"
+    """
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_loaded"] = False
+
+    def load(self):
+        """
+        Import the module now (e.g. from a warm-up thread)
+        """
+        module = importlib.import_module(self.__name__)
+        if not self._loaded:
+            # later lookups find the attributes directly instead of going
+            # through __getattr__
+            self.__dict__.update({k: v for k, v in module.__dict__.items() if k not in ("__name__", "__spec__", "__loader__")})
+            self.__dict__["_loaded"] = True
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._loaded else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+def lazy_import(name: str):
+    """
+    Module that is imported on first use (see LazyModule)
+    """
+    return LazyModule(name)
@@ -0,0 +1,364 @@
+import asyncio
+import atexit
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from google.oauth2.service_account import Credentials
+from . import storage as StorageHelper
+from .cache import get_document_cache, document_key, file_hash
+from .config import PipelineConfig
+from .docai import (start_batch_process_async, track_operation, output_destinations,
+                    process_document_online_async, use_online_processing,
+                    process_document_chunked_async, use_chunked_processing,
+                    document_output_shard)
+from .singleflight import SingleFlight
+from .lazy import lazy_import
+
+docai = lazy_import("google.cloud.documentai")
+
+# the same file uploaded by several sessions at once is only processed once
+_file_flight = SingleFlight("document upload")
+
+
+class Job:
+    """
+    Processing of the files of one upload; its status is polled by job id
+    """
+    def __init__(self, file_urls: list, parser_config, project_id: str, credentials: Optional[Credentials]):
+        self.id = uuid.uuid4().hex
+        self.file_urls = file_urls
+        self.parser_config = parser_config
+        self.project_id = project_id
+        self.credentials = credentials
+        self.results = [None] * len(file_urls)
+        self.cache_keys = [None] * len(file_urls)
+        self.content_hashes = [None] * len(file_urls)
+        self.progress = "queued"
+        self.error = None
+        self.finished = None
+
+        # files uploaded for a batch request, and files not yet routed or uploaded
+        self.batch = []
+        self.unrouted = len(file_urls)
+        self.uploading = 0
+        # files this job is processing on behalf of other sessions too
+        self.led = []
+
+        self.done = asyncio.Event()
+        self.changed = asyncio.Event()
+
+    def update(self, progress: str):
+        self.progress = progress
+        # wake up whoever is waiting on this job
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def status(self):
+        """
+        Snapshot of the job: state (queued, running, done, failed), progress
+        message, and the results once done
+        """
+        completed = sum(r is not None for r in self.results)
+        if self.error is not None:
+            state = "failed"
+        elif self.done.is_set():
+            state = "done"
+        elif self.progress == "queued":
+            state = "queued"
+        else:
+            state = "running"
+
+        return {"id": self.id,
+                "state": state,
+                "progress": f"{completed}/{len(self.file_urls)} file(s) done; {self.progress}",
+                "error": self.error,
+                "results": self.results if state == "done" else None}
+
+
+class Pipeline:
+    """
+    Staged document processing: upload -> OCR -> parse. Each stage has its
+    own bounded queue and number of workers (see PipelineConfig), so many
+    uploads can run at once while DocAI requests are kept to what the quota
+    allows and CPU bound parsing runs in a process pool. A full queue holds
+    up submit, which pushes back on the sessions uploading
+
+    Stages:
+        upload: content hash, document cache lookup, routing (online,
+            chunked or batch) and upload of the files for batch requests
+        ocr: DocAI requests; the batch files of a job go in a single request
+        parse: the DocAI output to summary, entities and text
+    """
+    def __init__(self):
+        self._jobs = {}
+        self._loop = None
+        self._workers = []
+        self._processes = None
+
+    def _start(self):
+        # queues and workers live on the event loop of the first submit
+        self._loop = asyncio.get_running_loop()
+        size = PipelineConfig.queue_size()
+        self._uploads = asyncio.Queue(size)
+        self._ocr = asyncio.Queue(size)
+        self._parse = asyncio.Queue(size)
+
+        stages = [(self._uploads, self._upload_stage, PipelineConfig.upload_workers()),
+                  (self._ocr, self._ocr_stage, PipelineConfig.ocr_workers()),
+                  (self._parse, self._parse_stage, PipelineConfig.parse_workers())]
+        for queue, stage, workers in stages:
+            self._workers += [asyncio.ensure_future(self._run(queue, stage)) for _ in range(workers)]
+
+        if PipelineConfig.parse_processes() > 0:
+            # spawn rather than fork; forking a process with grpc threads is unsafe
+            self._processes = ProcessPoolExecutor(max_workers=PipelineConfig.parse_processes(),
+                                                  mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(self._processes.shutdown, wait=False, cancel_futures=True)
+
+    async def submit(self,
+                     file_urls: list,
+                     parser_config,
+                     project_id: str,
+                     credentials: Optional[Credentials] = None):
+        """
+        Queue files for processing. Waits while the upload queue is full
+
+        Args:
+            file_urls (list): local file locations to be processed
+            parser_config: parser config class (SummaryParserConfig or ContractParserConfig)
+            project_id (str): project id where the processor is created
+            credentials (Credentials): Optional. credentials to run as
+
+        Returns:
+            job id to poll with status() or wait()
+        """
+        if self._loop is None:
+            self._start()
+        self._expire()
+
+        job = Job(file_urls, parser_config, project_id, credentials)
+        self._jobs[job.id] = job
+
+        for i in range(len(file_urls)):
+            await self._uploads.put((job, i))
+
+        return job.id
+
+    def status(self, job_id: str):
+        """
+        Status of a job (see Job.status), or None if it is unknown or expired
+        """
+        job = self._jobs.get(job_id)
+        return job.status() if job is not None else None
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None):
+        """
+        Wait until the job's progress changes or it is done, then return its status
+        """
+        job = self._jobs[job_id]
+        if not job.done.is_set():
+            try:
+                await asyncio.wait_for(job.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job.status()
+
+    def _expire(self):
+        # forget finished jobs nobody polled for a while
+        cutoff = time.time() - PipelineConfig.job_ttl_seconds()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+    async def _run(self, queue: asyncio.Queue, stage):
+        while True:
+            item = await queue.get()
+            job = item[0]
+            try:
+                if job.error is None:
+                    await stage(*item)
+            except Exception as e:
+                self._fail(job, e)
+            finally:
+                queue.task_done()
+
+    async def _upload_stage(self, job: Job, i: int):
+        config = job.parser_config
+        file_url = job.file_urls[i]
+        job.update("uploading")
+
+        content_hash = job.content_hashes[i] = await asyncio.to_thread(file_hash, file_url)
+        key = job.cache_keys[i] = document_key(content_hash, job.project_id, config.location(),
+                                               config.processor_id(), field_mask=config.field_mask())
+
+        # skip the upload and parsing of files that have already been processed
+        doc_cache = get_document_cache()
+        entry = await asyncio.to_thread(doc_cache.get, key) if doc_cache is not None else None
+        if entry is not None:
+            print(f"Document cache hit for {file_url}")
+            job.unrouted -= 1
+            self._complete(job, i, entry)
+        else:
+            await self._route(job, i, key)
+
+        # all of the job's batch files go in a single request once uploaded
+        if job.batch and job.unrouted == 0 and job.uploading == 0:
+            batch, job.batch = job.batch, []
+            await self._ocr.put((job, "batch", batch))
+
+    async def _route(self, job: Job, i: int, key: str):
+        config = job.parser_config
+        file_url = job.file_urls[i]
+        mime_type = config.mime_type()
+
+        # join a file that is already being processed rather than processing it again
+        future, leader = _file_flight.claim(key)
+        if not leader:
+            job.unrouted -= 1
+            asyncio.ensure_future(self._join(job, i, future))
+            return
+
+        # recorded straight after the claim, so that _fail releases the file
+        # whatever goes wrong below (e.g. pypdf failing on a corrupt pdf)
+        job.led.append(i)
+        if job.error is not None:
+            # the job failed while this file was being hashed
+            _file_flight.finish(key, error=job.error)
+            return
+
+        if await asyncio.to_thread(use_online_processing, file_url, mime_type):
+            job.unrouted -= 1
+            await self._ocr.put((job, "online", [i]))
+        elif await asyncio.to_thread(use_chunked_processing, file_url, mime_type):
+            job.unrouted -= 1
+            await self._ocr.put((job, "chunked", [i]))
+        else:
+            job.uploading += 1
+            job.unrouted -= 1
+            # uploaded under its content hash, so that files with the same name
+            # from other sessions don't overwrite it before DocAI reads it
+            f, gcs = await StorageHelper.file_upload_async(file_url, config.upload_bucket(), job.credentials,
+                                                           prefix=job.content_hashes[i])
+            job.batch.append((i, gcs))
+            job.uploading -= 1
+
+    async def _join(self, job: Job, i: int, future):
+        job.update("already being processed, waiting")
+        try:
+            self._complete(job, i, await asyncio.wrap_future(future))
+        except Exception as e:
+            self._fail(job, e)
+
+    async def _ocr_stage(self, job: Job, route: str, files: list):
+        config = job.parser_config
+        job.update(f"processing {len(files)} file(s)")
+
+        if route == "batch":
+            gcs_input_uris = [gcs for i, gcs in files]
+            operation = await start_batch_process_async(
+                project_id=job.project_id,
+                location=config.location(),
+                processor_id=config.processor_id(),
+                mime_type=config.mime_type(),
+                field_mask=config.field_mask(),
+                gcs_input_uri=gcs_input_uris,
+                gcs_output_uri=f"gs://{config.output_bucket()}",
+                credentials=job.credentials
+            )
+            async for metadata in track_operation(operation):
+                job.update(f"processing {len(files)} file(s) ({metadata.state.name.lower()})")
+
+            # map each input document back to its own output folder
+            destinations = output_destinations(metadata)
+            for i, gcs in files:
+                await self._parse.put((job, i, "gcs", destinations[gcs], gcs))
+            return
+
+        process = process_document_online_async if route == "online" else process_document_chunked_async
+        for i in files:
+            document = await process(
+                project_id=job.project_id,
+                location=config.location(),
+                processor_id=config.processor_id(),
+                mime_type=config.mime_type(),
+                field_mask=config.field_mask(),
+                file_url=job.file_urls[i],
+                credentials=job.credentials
+            )
+            # serialized so that it can be handed to a parse process
+            await self._parse.put((job, i, "document", docai.Document.serialize(document), job.file_urls[i]))
+
+    async def _parse_stage(self, job: Job, i: int, kind: str, payload, uri: str):
+        job.update("parsing")
+
+        # credentials can't be sent to another process; parse their output on a thread
+        executor = self._processes if kind == "document" or job.credentials is None else None
+        credentials = job.credentials if executor is None else None
+        summary, entities, text = await self._loop.run_in_executor(
+            executor, parse_output, kind, payload, uri, job.parser_config.field_mask(), credentials)
+
+        entry = {"gcs_input_uri": uri, "summary": summary, "entities": entities, "text": text}
+        doc_cache = get_document_cache()
+        if doc_cache is not None:
+            await asyncio.to_thread(doc_cache.put, job.cache_keys[i], entry)
+        _file_flight.finish(job.cache_keys[i], entry)
+        self._complete(job, i, entry)
+
+    def _complete(self, job: Job, i: int, entry: dict):
+        job.results[i] = entry
+        if all(r is not None for r in job.results):
+            job.finished = time.time()
+            job.done.set()
+        job.update("done" if job.done.is_set() else job.progress)
+
+    def _fail(self, job: Job, error: Exception):
+        if job.error is not None:
+            return
+        print(f"Job {job.id} failed: {error}")
+        job.error = error
+        job.finished = time.time()
+        # don't leave other sessions waiting on files this job failed to process
+        for i in job.led:
+            _file_flight.finish(job.cache_keys[i], error=error)
+        job.done.set()
+        job.update("failed")
+
+
+def parse_output(kind: str, payload, uri: str, field_mask: Optional[str], credentials: Optional[Credentials] = None):
+    """
+    Summary, entities and text of a DocAI output. Runs in a parse process,
+    so it only takes and returns picklable values
+
+    Args:
+        kind: "document" for a serialized Document, "gcs" for a batch output folder
+        payload: serialized Document, or gcs uri of the output folder
+        uri: uri of the input file
+        field_mask: Optional. only parse these fields out of the output json
+        credentials: Optional. credentials to read the output with (threads only)
+    """
+    if kind == "document":
+        shards = [document_output_shard(docai.Document.deserialize(payload), uri)]
+    else:
+        shards = StorageHelper.iter_output_shards(payload, credentials, field_mask)
+
+    json_uri, summary, entities, text = StorageHelper.collect_output(shards)
+    return summary, entities, text
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline():
+    """
+    Process-wide Pipeline
+    """
+    global _pipeline
+
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = Pipeline()
+
+    return _pipeline
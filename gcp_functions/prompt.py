@@ -0,0 +1,147 @@
+import math
+from typing import Optional
+from .config import GeminiConfig
+
+# rough number of characters per token for english text
+_CHARS_PER_TOKEN = 4
+
+# older chat turns are cut down to this many characters before being dropped
+_COMPACT_TURN_CHARS = 200
+
+_INSTRUCTIONS = """
+    Answer any questions using only data from the context below:\n
+
+    {ground_text}
+
+    Do not answer any questions where you do not have context for.
+    {history}
+    Question: {message}
+    """
+
+
+# used when the document is already in the model's cached context
+_CACHED_INSTRUCTIONS = """
+    Answer any questions using only data from the document provided as context.
+
+    Do not answer any questions where you do not have context for.
+    {history}
+    Question: {message}
+    """
+
+
+def estimate_tokens(text: str):
+    """
+    Local estimate of the number of tokens in text; no api call
+    """
+    return math.ceil(len(text) / _CHARS_PER_TOKEN)
+
+
+def count_tokens(text: str, model=None):
+    """
+    Number of tokens in text. Uses the model's count_tokens api when
+    GeminiConfig.exact_token_count() is set and a model is given, otherwise
+    the local estimate
+    """
+    if model is not None and GeminiConfig.exact_token_count():
+        return model.count_tokens(text).total_tokens
+    return estimate_tokens(text)
+
+
+def _truncate(text: str, tokens: int):
+    # cut text down to about the given number of tokens
+    max_chars = max(tokens, 0) * _CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars]
+
+
+def _turns(history):
+    """
+    (user, assistant) pairs from a Gradio chat history, in either the
+    tuples format or the messages (role/content dicts) format
+    """
+    turns = []
+    for item in history or []:
+        if isinstance(item, dict):
+            if item.get("role") == "user":
+                turns.append([item.get("content") or "", ""])
+            elif turns:
+                turns[-1][1] = f"{turns[-1][1]}{item.get('content') or ''}"
+        else:
+            user, assistant = item
+            turns.append([user or "", assistant or ""])
+    return turns
+
+
+def _format_history(history, budget: int):
+    """
+    Recent chat turns that fit in the budget, oldest first. The newest
+    turns are kept whole; older ones are compacted and then dropped
+    """
+    lines = []
+    used = 0
+    for user, assistant in reversed(_turns(history)):
+        turn = f"User: {user}\nAssistant: {assistant}"
+        if used + estimate_tokens(turn) > budget:
+            # compact the turn down to its start
+            turn = f"User: {user[:_COMPACT_TURN_CHARS]}\nAssistant: {assistant[:_COMPACT_TURN_CHARS]}"
+            if used + estimate_tokens(turn) > budget:
+                break
+        lines.append(turn)
+        used += estimate_tokens(turn)
+
+    if not lines:
+        return ""
+    return "\n    Conversation so far:\n" + "\n".join(reversed(lines)) + "\n"
+
+
+def build_docqa_prompt(message: str,
+                       history,
+                       ground_text: Optional[str],
+                       budget: Optional[int] = None,
+                       model=None):
+    """
+    Assemble the document QA prompt within a token budget. The question and
+    instructions always go in; recent chat history may use up to
+    GeminiConfig.history_token_share() of what is left, and the grounding
+    text is truncated to fit the rest
+
+    Args:
+        message: the question to send to the LLM
+        history: chat history, in Gradio tuples or messages format
+        ground_text: text to use as context for the prompt, or None if the
+            model already holds the document in a cached context
+        budget: Optional. max prompt tokens (see GeminiConfig.max_prompt_tokens)
+        model: Optional. model to count tokens exactly with (see GeminiConfig.exact_token_count)
+
+    Returns:
+        prompt text
+    """
+    if budget is None:
+        budget = GeminiConfig.max_prompt_tokens()
+
+    if ground_text is None:
+        fixed = estimate_tokens(_CACHED_INSTRUCTIONS.format(history="", message=message))
+        history_text = _format_history(history, int(max(budget - fixed, 0) * GeminiConfig.history_token_share()))
+        return _CACHED_INSTRUCTIONS.format(history=history_text, message=message)
+
+    fixed = estimate_tokens(_INSTRUCTIONS.format(ground_text="", history="", message=message))
+    remaining = max(budget - fixed, 0)
+
+    history_text = _format_history(history, int(remaining * GeminiConfig.history_token_share()))
+    remaining -= estimate_tokens(history_text)
+
+    prompt = _INSTRUCTIONS.format(ground_text=_truncate(ground_text, remaining),
+                                  history=history_text,
+                                  message=message)
+
+    # the estimate can be off for some text; shrink the context to fit the exact count
+    if model is not None and GeminiConfig.exact_token_count():
+        total = count_tokens(prompt, model)
+        if total > budget:
+            remaining = int(remaining * budget / total)
+            prompt = _INSTRUCTIONS.format(ground_text=_truncate(ground_text, remaining),
+                                          history=history_text,
+                                          message=message)
+
+    return prompt
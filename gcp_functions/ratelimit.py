@@ -0,0 +1,229 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Optional
+from google.api_core.exceptions import ResourceExhausted, TooManyRequests, DeadlineExceeded
+from .config import RateLimitConfig
+
+# errors that mean the quota is used up; these are retried after a backoff
+QUOTA_ERRORS = (ResourceExhausted, TooManyRequests)
+
+# seconds between checks for a free slot in acquire_async
+_ASYNC_POLL = 0.05
+
+
+class AdaptiveLimiter:
+    """
+    Token bucket limiting the request rate to a service, combined with an
+    AIMD limit on concurrent requests: the limit grows by one request per
+    window of successes and is halved on a quota error, so the number of
+    requests in flight settles just under what the quota allows. The limit
+    is halved at most once per congestion window: quota errors of requests
+    that started before the last decrease are part of the same overload
+
+    Args:
+        name: name used in log messages
+        rate: requests per second
+        burst: max tokens the bucket holds
+        max_concurrency: upper bound of the concurrency limit
+    """
+    def __init__(self, name: str, rate: float, burst: int, max_concurrency: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        # when the limit was last halved
+        self._decreased = float("-inf")
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: Optional[float] = None):
+        """
+        Wait for a token and a concurrency slot
+
+        Args:
+            timeout: Optional. seconds to wait before raising DeadlineExceeded
+
+        Returns:
+            start time of the request, to pass to release
+        """
+        end = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                acquired, wait = self._try_acquire()
+                if acquired:
+                    return time.monotonic()
+                wait = self._wait_until(end, wait, timeout)
+                # wake up when the next token is due, or when a slot is released
+                self._cond.wait(wait)
+
+    async def acquire_async(self, timeout: Optional[float] = None):
+        """
+        Async version of acquire; waits without blocking the event loop
+        """
+        end = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._cond:
+                acquired, wait = self._try_acquire()
+            if acquired:
+                return time.monotonic()
+            # slots released by other requests aren't signalled to coroutines; poll
+            wait = min(wait, _ASYNC_POLL) if wait is not None else _ASYNC_POLL
+            await asyncio.sleep(self._wait_until(end, wait, timeout))
+
+    def _wait_until(self, end: Optional[float], wait: Optional[float], timeout: Optional[float]):
+        # wait, cut short at end; raises once end has passed
+        if end is None:
+            return wait
+        left = end - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceeded(f"{self.name}: no request slot within {timeout}s")
+        return left if wait is None else min(wait, left)
+
+    def _try_acquire(self):
+        """
+        Take a token and a slot if both are available. Returns whether they
+        were taken, and otherwise the seconds until the next token (None if
+        waiting on a slot). Caller holds the lock
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        if self.in_flight < int(self.limit) and self._tokens >= 1:
+            self._tokens -= 1
+            self.in_flight += 1
+            return True, None
+
+        return False, (1 - self._tokens) / self.rate if self._tokens < 1 else None
+
+    def release(self, started: float, quota_error: bool = False, success: bool = True):
+        """
+        Give back a concurrency slot, adapting the limit to how the request went
+
+        Args:
+            started: start time of the request, as returned by acquire
+            quota_error: the request failed on the quota; halves the limit,
+                unless it started before the last decrease
+            success: the request succeeded; only successes grow the limit
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if quota_error:
+                if started >= self._decreased:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._decreased = time.monotonic()
+                    print(f"{self.name}: quota exceeded, concurrency limit down to {int(self.limit)}")
+            elif success:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def _left(end: Optional[float]):
+    # seconds left until end (time.monotonic), or None if there is no end
+    return max(end - time.monotonic(), 0) if end is not None else None
+
+
+def get_limiter(service: str, project_id: str, location: str):
+    """
+    Process-wide limiter for a service in a project and location, configured
+    by RateLimitConfig
+    """
+    key = (service, project_id, location)
+    with _lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = AdaptiveLimiter(f"{service} {project_id}/{location}",
+                                      RateLimitConfig.qps(service),
+                                      RateLimitConfig.burst(service),
+                                      RateLimitConfig.max_concurrency(service))
+            _limiters[key] = limiter
+    return limiter
+
+
+def call_with_retry(service: str,
+                    project_id: str,
+                    location: str,
+                    fn: Callable,
+                    deadline: Optional[float] = None):
+    """
+    Call fn() through the service's limiter, retrying quota errors with
+    exponential backoff and full jitter (see RateLimitConfig)
+
+    Args:
+        service: name of the service (gemini, documentai, discoveryengine)
+        project_id: project the quota belongs to
+        location: location of the service
+        fn: the request to make
+        deadline: Optional. seconds the call may take, waits and retries
+            included; raises DeadlineExceeded (or the last quota error) after
+
+    Returns:
+        result of fn()
+    """
+    limiter = get_limiter(service, project_id, location)
+    attempts = RateLimitConfig.max_retries() + 1
+    end = time.monotonic() + deadline if deadline is not None else None
+
+    for attempt in range(attempts):
+        started = limiter.acquire(_left(end))
+        try:
+            result = fn()
+        except QUOTA_ERRORS:
+            limiter.release(started, quota_error=True)
+            backoff = random.uniform(0, min(RateLimitConfig.backoff_max(),
+                                            RateLimitConfig.backoff_base() * 2 ** attempt))
+            # no retry that would end past the deadline
+            if attempt == attempts - 1 or (end is not None and time.monotonic() + backoff >= end):
+                raise
+            time.sleep(backoff)
+            continue
+        except BaseException:
+            # other failures say nothing about the quota; don't grow the limit on them
+            limiter.release(started, success=False)
+            raise
+
+        limiter.release(started)
+        return result
+
+
+async def call_with_retry_async(service: str,
+                                project_id: str,
+                                location: str,
+                                fn: Callable,
+                                deadline: Optional[float] = None):
+    """
+    Async version of call_with_retry; fn returns an awaitable
+    """
+    limiter = get_limiter(service, project_id, location)
+    attempts = RateLimitConfig.max_retries() + 1
+    end = time.monotonic() + deadline if deadline is not None else None
+
+    for attempt in range(attempts):
+        started = await limiter.acquire_async(_left(end))
+        try:
+            result = await fn()
+        except QUOTA_ERRORS:
+            limiter.release(started, quota_error=True)
+            backoff = random.uniform(0, min(RateLimitConfig.backoff_max(),
+                                            RateLimitConfig.backoff_base() * 2 ** attempt))
+            # no retry that would end past the deadline
+            if attempt == attempts - 1 or (end is not None and time.monotonic() + backoff >= end):
+                raise
+            await asyncio.sleep(backoff)
+            continue
+        except BaseException:
+            # other failures say nothing about the quota; don't grow the limit on them
+            limiter.release(started, success=False)
+            raise
+
+        limiter.release(started)
+        return result
@@ -0,0 +1,147 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+from .config import RetrievalConfig
+
+_TOKEN = re.compile(r"\w+")
+
+# BM25 parameters
+_K1 = 1.5
+_B = 0.75
+
+
+def tokenize(text: str):
+    return _TOKEN.findall(text.lower())
+
+
+class DocumentIndex:
+    """
+    BM25 index over overlapping word passages of a document. Postings are
+    stored as flat numpy arrays sorted by term, with the BM25 weight of
+    every (term, passage) pair precomputed, so a query is a handful of
+    array slices and a bincount
+    """
+    def __init__(self, text: str, chunk_words: int, chunk_overlap: int):
+        words = text.split()
+        step = max(1, chunk_words - chunk_overlap)
+        self.passages = [" ".join(words[i:i + chunk_words])
+                         for i in range(0, max(len(words) - chunk_overlap, 1), step)]
+        n = len(self.passages)
+
+        # map every token to a term id, remembering which passage it came from
+        self.vocabulary = {}
+        term_ids = []
+        lengths = []
+        for passage in self.passages:
+            tokens = tokenize(passage)
+            lengths.append(len(tokens))
+            term_ids.extend(self.vocabulary.setdefault(t, len(self.vocabulary)) for t in tokens)
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        passage_ids = np.repeat(np.arange(n, dtype=np.int64), lengths)
+
+        # term frequency of each (term, passage) pair, sorted by term
+        pairs, tf = np.unique(term_ids * n + passage_ids, return_counts=True)
+        terms = pairs // n
+        self.postings = pairs % n
+        self.indptr = np.searchsorted(terms, np.arange(len(self.vocabulary) + 1))
+
+        df = np.diff(self.indptr)
+        idf = np.log1p((n - df + 0.5) / (df + 0.5))
+        doc_len = np.asarray(lengths, dtype=np.float64)
+        norm = _K1 * (1 - _B + _B * doc_len / max(doc_len.mean(), 1.0))
+        self.weights = (idf[terms] * tf * (_K1 + 1) / (tf + norm[self.postings])).astype(np.float32)
+
+    def search(self, query: str, top_k: int):
+        """
+        Indexes of the top_k passages for the query, best first
+        """
+        term_ids = {self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary}
+        if not term_ids:
+            return []
+
+        idx = np.concatenate([np.arange(self.indptr[t], self.indptr[t + 1]) for t in term_ids])
+        scores = np.bincount(self.postings[idx], weights=self.weights[idx], minlength=len(self.passages))
+
+        top_k = min(top_k, int(np.count_nonzero(scores)))
+        if top_k <= 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        return best[np.argsort(-scores[best])].tolist()
+
+
+# process-wide indexes of recently used documents, keyed by content hash
+_MAX_INDEXES = 32
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_index(text: str):
+    """
+    Index of a document, built on first use and kept for later questions
+
+    Args:
+        text: full OCR text of the document
+
+    Returns:
+        DocumentIndex
+    """
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+
+    index = DocumentIndex(text, RetrievalConfig.chunk_words(), RetrievalConfig.chunk_overlap())
+
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > _MAX_INDEXES:
+            _indexes.popitem(last=False)
+
+    return index
+
+
+def needs_index(text: str):
+    """
+    Whether a document is large enough to be queried through an index
+    rather than sent whole as context
+    """
+    return RetrievalConfig.enabled() and len(text) > RetrievalConfig.full_context_max_chars()
+
+
+def build_index(text: str):
+    """
+    Build the index of a document ahead of its first question. Does nothing
+    for documents small enough to be sent whole
+    """
+    if needs_index(text):
+        get_index(text)
+
+
+def select_context(text: str, question: str):
+    """
+    Context to ground a question in: the whole document if it is small,
+    otherwise the passages most relevant to the question in document order
+
+    Args:
+        text: full OCR text of the document
+        question: the question to answer
+
+    Returns:
+        context text for the prompt
+    """
+    if not needs_index(text):
+        return text
+
+    index = get_index(text)
+    best = index.search(question, RetrievalConfig.top_k())
+    if not best:
+        # nothing matched; fall back to the whole document
+        return text
+
+    return "\n...\n".join(index.passages[i] for i in sorted(best))
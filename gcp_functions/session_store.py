@@ -0,0 +1,346 @@
+import asyncio
+import functools
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+import gradio as gr
+from .config import SessionStoreConfig
+from .stateBag import StateBag
+from .text_store import get_text_store
+
+# optional; needed for SESSION_STORE=redis
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend:
+    """
+    Session store backend in the process's memory. Only shared by the
+    threads of one process; useful for a single worker and for testing
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key: str, value: bytes, ttl: int):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+
+    def touch(self, key: str, ttl: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.time():
+                return False
+            self._entries[key] = (entry[0], time.time() + ttl)
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteBackend:
+    """
+    Session store backend in a local sqlite file; shared by the worker
+    processes of one host
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+        self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sessions WHERE key = ? AND expires >= ?",
+                                     (key, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key: str, value: bytes, ttl: int):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sessions (key, value, expires) VALUES (?, ?, ?)",
+                               (key, value, now + ttl))
+            # drop expired sessions and texts as we go
+            self._conn.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+            self._conn.commit()
+
+    def touch(self, key: str, ttl: int):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute("UPDATE sessions SET expires = ? WHERE key = ? AND expires >= ?",
+                                        (now + ttl, key, now))
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            self._conn.commit()
+
+
+class RedisBackend:
+    """
+    Session store backend on a Redis compatible server; shared by workers
+    on any host
+
+    Args:
+        client: client with the redis-py get / set(ex=) / expire / delete methods
+            (e.g. redis.Redis, or a local stand-in with the same methods)
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key: str):
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: int):
+        self.client.set(key, value, ex=ttl)
+
+    def touch(self, key: str, ttl: int):
+        return bool(self.client.expire(key, ttl))
+
+    def delete(self, key: str):
+        self.client.delete(key)
+
+
+class SessionStore:
+    """
+    Session state kept outside of the process, so that several app processes
+    behind a load balancer can serve any session: each event restores the
+    session's StateBag from the store and saves it back afterwards (see
+    session_handler). The documents the bags refer to are stored alongside
+    them, so a process can load a document another process stored
+
+    Several events of a session can run at once, so state is merged per
+    field: restoring leaves fields that an event of this process changed
+    but has not saved yet, and saving only writes the fields changed here
+
+    Args:
+        backend: MemoryBackend, SQLiteBackend, RedisBackend, or anything with
+            the same get / set / touch / delete methods
+        ttl: seconds a session (and its document) is kept after its last save
+    """
+    def __init__(self, backend, ttl: int):
+        self.backend = backend
+        self.ttl = ttl
+        self._pruned = time.time()
+        # each session's values as last loaded from or saved to the store by
+        # this process, to tell which fields were changed here since
+        self._synced = {}
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str):
+        """
+        The saved values of a session (see StateBag.to_dict), or None
+        """
+        value = self.backend.get(f"session:{session_id}")
+        return json.loads(value) if value is not None else None
+
+    def restore(self, session_id: str, bag: StateBag):
+        """
+        Replace the values of bag with the session's saved values, if any,
+        except for those changed by this process and not saved yet
+
+        Returns:
+            True if the session was found
+        """
+        data = self.load(session_id)
+        if data is None:
+            return False
+
+        with self._lock:
+            synced = self._synced.get(session_id)
+            self._synced[session_id] = (data, time.time())
+        if synced is not None:
+            # keep the fields an event of this process changed and hasn't saved yet
+            local = bag.to_dict()
+            data = {k: local[k] if local.get(k) != synced[0].get(k) else v for k, v in data.items()}
+        bag.load_dict(data)
+        return True
+
+    def save(self, session_id: str, bag: StateBag):
+        """
+        Save bag as the session's state, along with its document
+        """
+        handle = bag.ocr_handle
+        now = time.time()
+        # the document lives as long as the session; it is only written if
+        # the store doesn't have it already
+        text_key = f"text:{handle}"
+        if handle is not None and not self.backend.touch(text_key, self.ttl):
+            self.backend.set(text_key, zlib.compress(bag.ocr_text.encode("utf-8"), 1), self.ttl)
+
+        with self._lock:
+            if now - self._pruned > self.ttl / 2:
+                # forget sessions that have expired from the store by now
+                self._synced = {s: v for s, v in self._synced.items() if now - v[1] <= self.ttl}
+                self._pruned = now
+
+        data = bag.to_dict()
+        with self._lock:
+            synced = self._synced.get(session_id)
+        if synced is not None:
+            # only write the fields changed here, over what other processes saved since
+            changed = {k: v for k, v in data.items() if synced[0].get(k) != v}
+            data = {**(self.load(session_id) or synced[0]), **changed}
+
+        self.backend.set(f"session:{session_id}", json.dumps(data).encode("utf-8"), self.ttl)
+        with self._lock:
+            self._synced[session_id] = (data, now)
+
+    def delete(self, session_id: str):
+        """
+        Drop a session's saved state, e.g. when it ends. Its document is
+        left to expire, since other sessions may refer to it
+        """
+        self.backend.delete(f"session:{session_id}")
+        with self._lock:
+            self._synced.pop(session_id, None)
+
+    def get_text(self, handle: str):
+        """
+        A document saved with a session, or None
+        """
+        value = self.backend.get(f"text:{handle}")
+        return zlib.decompress(value).decode("utf-8") if value is not None else None
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    Process-wide SessionStore, or None if sessions are only kept in the
+    process (see SessionStoreConfig.backend)
+    """
+    global _session_store
+
+    backend = SessionStoreConfig.backend()
+    if not backend:
+        return None
+
+    with _session_store_lock:
+        if _session_store is None:
+            if backend == "memory":
+                store_backend = MemoryBackend()
+            elif backend == "sqlite":
+                store_backend = SQLiteBackend(SessionStoreConfig.path())
+            elif backend == "redis":
+                if redis is None:
+                    raise ImportError("SESSION_STORE=redis needs the redis package (pip install redis)")
+                store_backend = RedisBackend(redis.Redis.from_url(SessionStoreConfig.url()))
+            else:
+                raise ValueError(f"Unknown SESSION_STORE: {backend}")
+
+            _session_store = SessionStore(store_backend, SessionStoreConfig.ttl_seconds())
+            # documents saved by other processes are loaded from the store
+            get_text_store().loader = _session_store.get_text
+
+    return _session_store
+
+
+def session_handler(fn):
+    """
+    Decorator for Gradio event handlers that take the session state as a
+    "state" argument. When a session store is configured, the state is
+    restored from the store before the handler runs and saved back after,
+    so any app process can serve the session. Handlers can be functions,
+    coroutine functions, or (async) generators
+
+    Gradio passes the request (for its session id) to the wrapper through
+    the added "request" argument
+    """
+    signature = inspect.signature(fn)
+    state_index = list(signature.parameters).index("state")
+    count = len(signature.parameters)
+
+    def split(args, kwargs):
+        # Gradio passes the request as an extra positional argument
+        if len(args) > count:
+            return args[:count], args[count]
+        return args, kwargs.get("request")
+
+    def session(args, request):
+        store = get_session_store()
+        if store is None or request is None or not request.session_hash:
+            return None
+        bag = args[state_index]
+        store.restore(request.session_hash, bag)
+        # so that the session can be deleted from the store when it ends
+        bag.session_id = request.session_hash
+        return store, request.session_hash
+
+    def save(context, args):
+        if context is not None:
+            store, session_id = context
+            store.save(session_id, args[state_index])
+
+    if inspect.isasyncgenfunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            args, request = split(args, kwargs)
+            context = await asyncio.to_thread(session, args, request)
+            async for value in fn(*args):
+                yield value
+            await asyncio.to_thread(save, context, args)
+    elif inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            args, request = split(args, kwargs)
+            context = await asyncio.to_thread(session, args, request)
+            value = await fn(*args)
+            await asyncio.to_thread(save, context, args)
+            return value
+    elif inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            args, request = split(args, kwargs)
+            context = session(args, request)
+            yield from fn(*args)
+            save(context, args)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            args, request = split(args, kwargs)
+            context = session(args, request)
+            value = fn(*args)
+            save(context, args)
+            return value
+
+    # Gradio finds the request argument by its annotation
+    request = inspect.Parameter("request", inspect.Parameter.POSITIONAL_OR_KEYWORD, default=None, annotation=gr.Request)
+    wrapper.__signature__ = signature.replace(parameters=[*signature.parameters.values(), request])
+    wrapper.__annotations__ = {**fn.__annotations__, "request": gr.Request}
+    return wrapper
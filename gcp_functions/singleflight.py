@@ -0,0 +1,266 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class _Broadcast:
+    """
+    Chunks of a streamed call, shared with every session waiting on it
+    """
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        # sessions reading the stream; it is stopped once none are left
+        self.readers = 1
+        self.cond = threading.Condition()
+
+
+class _AsyncBroadcast:
+    """
+    Chunks of a streamed async call; waiters are woken through an event
+    that is replaced after every chunk
+    """
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.readers = 1
+        self.task = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is in
+    flight, other callers with the same key wait for it and get its result
+    (or its exception) instead of making their own call. Nothing is kept
+    once the call completes; caching results is up to the caller
+
+    Args:
+        name: name used in log messages
+    """
+    def __init__(self, name: str):
+        self.name = name
+        # number of calls that were served by another caller's call
+        self.shared = 0
+        self._calls = {}
+        self._streams = {}
+        self._async_streams = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """
+        Join the in-flight call for key, or become the one making it
+
+        Returns:
+            future: resolves to the call's result
+            leader: True if the caller must make the call and then finish(key, ...)
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                print(f"{self.name}: joining in-flight call ({self.shared} shared)")
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            return future, True
+
+    def finish(self, key, result=None, error: BaseException | None = None):
+        """
+        Complete the in-flight call for key, waking every caller waiting on it
+        """
+        with self._lock:
+            future = self._calls.pop(key, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) unless an identical call is already in
+        flight, in which case wait for that call's result
+        """
+        future, leader = self.claim(key)
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """
+        Async version of do; fn is a coroutine function. Waits without
+        blocking the event loop, also on calls made from other threads
+        """
+        future, leader = self.claim(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+    def stream(self, key, fn, *args, **kwargs):
+        """
+        Streaming version of do for a fn that returns an iterable: fn is
+        iterated on a thread of its own and every caller with the same key
+        gets each chunk as it arrives, from the start. Any caller can stop
+        reading without cutting the stream short for the others; it is
+        only stopped once none of them are left
+
+        Yields:
+            chunks of fn's iterable
+        """
+        with self._lock:
+            broadcast = self._streams.get(key)
+            leader = broadcast is None
+            if leader:
+                broadcast = self._streams[key] = _Broadcast()
+            else:
+                broadcast.readers += 1
+                self.shared += 1
+                print(f"{self.name}: joining in-flight stream ({self.shared} shared)")
+
+        if leader:
+            threading.Thread(target=self._drive, args=(key, broadcast, fn, args, kwargs),
+                             name=f"{self.name} stream", daemon=True).start()
+
+        try:
+            yield from self._follow(broadcast)
+        finally:
+            with self._lock:
+                broadcast.readers -= 1
+
+    def _drive(self, key, broadcast: _Broadcast, fn, args, kwargs):
+        iterable = None
+        completed = False
+        error = None
+        try:
+            iterable = fn(*args, **kwargs)
+            for chunk in iterable:
+                with self._lock:
+                    if broadcast.readers == 0:
+                        # every session stopped reading
+                        break
+                with broadcast.cond:
+                    broadcast.chunks.append(chunk)
+                    broadcast.cond.notify_all()
+            else:
+                completed = True
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+            with broadcast.cond:
+                if error is None and not completed:
+                    error = RuntimeError(f"{self.name}: shared stream was stopped")
+                broadcast.error = error
+                broadcast.done = True
+                broadcast.cond.notify_all()
+
+    def _follow(self, broadcast: _Broadcast):
+        sent = 0
+        while True:
+            with broadcast.cond:
+                broadcast.cond.wait_for(lambda: len(broadcast.chunks) > sent or broadcast.done)
+                chunks = broadcast.chunks[sent:]
+                done = broadcast.done
+                error = broadcast.error
+            for chunk in chunks:
+                yield chunk
+            sent += len(chunks)
+            if done and sent >= len(broadcast.chunks):
+                if error is not None:
+                    raise error
+                return
+
+    async def stream_async(self, key, fn, *args, **kwargs):
+        """
+        Async version of stream for an fn that returns an async iterable;
+        fn is iterated on a task of its own. Streams are shared between
+        callers on the same event loop
+        """
+        key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            broadcast = self._async_streams.get(key)
+            if broadcast is None:
+                broadcast = self._async_streams[key] = _AsyncBroadcast()
+                broadcast.task = asyncio.ensure_future(self._drive_async(key, broadcast, fn, args, kwargs))
+            else:
+                broadcast.readers += 1
+                self.shared += 1
+                print(f"{self.name}: joining in-flight stream ({self.shared} shared)")
+
+        try:
+            async for chunk in self._follow_async(broadcast):
+                yield chunk
+        finally:
+            with self._lock:
+                broadcast.readers -= 1
+                stop = broadcast.readers == 0 and not broadcast.done
+                if stop and self._async_streams.get(key) is broadcast:
+                    del self._async_streams[key]
+            if stop:
+                # every session stopped reading
+                broadcast.task.cancel()
+
+    async def _drive_async(self, key, broadcast: _AsyncBroadcast, fn, args, kwargs):
+        iterable = None
+        completed = False
+        error = None
+        try:
+            iterable = fn(*args, **kwargs)
+            async for chunk in iterable:
+                broadcast.chunks.append(chunk)
+                broadcast.notify()
+            completed = True
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                if self._async_streams.get(key) is broadcast:
+                    del self._async_streams[key]
+            close = getattr(iterable, "aclose", None)
+            if close is not None:
+                await close()
+            if error is None and not completed:
+                error = RuntimeError(f"{self.name}: shared stream was stopped")
+            broadcast.error = error
+            broadcast.done = True
+            broadcast.notify()
+
+    async def _follow_async(self, broadcast: _AsyncBroadcast):
+        sent = 0
+        while True:
+            changed = broadcast.changed
+            while sent < len(broadcast.chunks):
+                yield broadcast.chunks[sent]
+                sent += 1
+            if broadcast.done:
+                if broadcast.error is not None:
+                    raise broadcast.error
+                return
+            await changed.wait()
@@ -1,13 +1,105 @@
+from .text_store import get_text_store
+
+
 class StateBag:
+    """
+    Session state. The ocr text is not kept in the bag itself, only a handle
+    to it in the shared text store (see gcp_functions.text_store), so that
+    each session's copy of the bag stays small and a document open in many
+    sessions is stored once. Call close() when the session ends
+
+    The bag can be serialised with to_dict() / from_dict() (or pickled), so
+    that sessions can be shared between processes
+    """
+    __slots__ = ("_active_tab", "_ocr_handle", "_engine_id", "_project_id", "_job_id", "_session_id",
+                 "_cached_context")
+
     def __init__(self, 
                 active_tab: str | None = "", 
                 ocr_text: str | None = "", 
                 engine_id: str | None = "", 
-                project_id: str | None = ""):
+                project_id: str | None = "",
+                job_id: str | None = "",
+                session_id: str | None = ""):
         self._active_tab = active_tab
-        self._ocr_text = ocr_text
+        self._ocr_handle = get_text_store().put(ocr_text)
         self._engine_id = engine_id
         self._project_id = project_id
+        self._job_id = job_id
+        self._session_id = session_id
+        self._cached_context = None
+
+    def to_dict(self):
+        """
+        The bag's values as a json serialisable dict; the ocr text is
+        represented by its handle
+        """
+        return {"active_tab": self._active_tab,
+                "ocr_handle": self._ocr_handle,
+                "engine_id": self._engine_id,
+                "project_id": self._project_id,
+                "job_id": self._job_id,
+                "session_id": self._session_id}
+
+    def load_dict(self, data: dict):
+        """
+        Replace the bag's values with those of a dict from to_dict (e.g. one
+        saved by another process, see gcp_functions.session_store)
+        """
+        store = get_text_store()
+        handle = data.get("ocr_handle")
+        store.acquire(handle)
+        previous, self._ocr_handle = self._ocr_handle, handle
+        store.release(previous)
+
+        self._active_tab = data.get("active_tab", "")
+        self._engine_id = data.get("engine_id", "")
+        self._project_id = data.get("project_id", "")
+        self._job_id = data.get("job_id", "")
+        self._session_id = data.get("session_id", "")
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """
+        New bag with the values of a dict from to_dict
+        """
+        bag = cls.__new__(cls)
+        bag._ocr_handle = None
+        bag._cached_context = None
+        bag.load_dict(data)
+        return bag
+
+    # pickling and copying go through the dict, so that every copy takes
+    # its own reference to the stored text (Gradio deep copies the initial
+    # bag for every session)
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, data: dict):
+        self._ocr_handle = None
+        self._cached_context = None
+        self.load_dict(data)
+
+    def __deepcopy__(self, memo):
+        return StateBag.from_dict(self.to_dict())
+
+    def __copy__(self):
+        return StateBag.from_dict(self.to_dict())
+
+    def close(self):
+        """
+        Let go of the session's ocr text; it is dropped from the text store
+        once no other session holds it
+        """
+        handle, self._ocr_handle = self._ocr_handle, None
+        get_text_store().release(handle)
+
+    def __del__(self):
+        # also covers sessions Gradio drops without calling the delete callback
+        try:
+            self.close()
+        except Exception:
+            pass
 
     @property
     def active_tab(self):
@@ -20,12 +112,21 @@ class StateBag:
 
     @property
     def ocr_text(self):
-        return self._ocr_text
+        return get_text_store().get(self._ocr_handle)
 
     @ocr_text.setter
     def ocr_text(self, value: str):
-        print(f"set ocr_text to {value}")
-        self._ocr_text = value
+        store = get_text_store()
+        handle, self._ocr_handle = self._ocr_handle, store.put(value)
+        store.release(handle)
+        print(f"set ocr_text to {self._ocr_handle} ({len(value or '')} chars)")
+
+    @property
+    def ocr_handle(self):
+        """
+        Content hash of the ocr text (None if there is none)
+        """
+        return self._ocr_handle
 
     @property
     def engine_id(self):
@@ -43,4 +144,38 @@ class StateBag:
     @project_id.setter
     def project_id(self, value: str):
         print(f"set project_id to {value}")
-        self._project_id = value        
+        self._project_id = value
+
+    @property
+    def job_id(self):
+        return self._job_id
+
+    @job_id.setter
+    def job_id(self, value: str):
+        print(f"set job_id to {value}")
+        self._job_id = value
+
+    @property
+    def session_id(self):
+        """
+        Id the session is saved under in the session store (see
+        gcp_functions.session_store), or "" if it isn't saved
+        """
+        return self._session_id
+
+    @session_id.setter
+    def session_id(self, value: str):
+        self._session_id = value
+
+    @property
+    def cached_context(self):
+        """
+        (text hash, model name) of the cached context this process holds for
+        the session, or None (see gcp_functions.context_cache). Not saved
+        with the session, since cached contexts are counted per process
+        """
+        return self._cached_context
+
+    @cached_context.setter
+    def cached_context(self, value: tuple | None):
+        self._cached_context = value
@@ -1,13 +1,25 @@
+import asyncio
 import os
-import json
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from google.cloud import storage
-from typing import Optional
+from typing import Iterable, NamedTuple, Optional
 from google.oauth2.service_account import Credentials
+from .clients import get_storage_client
+from .config import StorageConfig
+from . import docai_json
+
+# docai batch output shards are named <input file name>-<shard index>.json
+_SHARD_INDEX = re.compile(r"-(\d+)\.json$")
+
+# read size when streaming shards; keeps the download buffer small
+_STREAM_CHUNK_SIZE = 1024 * 1024
 
 def file_upload(file_url: str, 
                 upload_bucket: str,
-                credentials: Optional[Credentials] = None):
+                credentials: Optional[Credentials] = None,
+                prefix: Optional[str] = None):
     """
     Helper function to upload a local file from gr.File() 
     to a designated Cloud Storage bucket
@@ -16,6 +28,9 @@ def file_upload(file_url: str,
         file_url: the local file path of he file to upload
         upload_bucket: bucket name to upload file to
         credentials: Optional. set to run as a specific user
+        prefix: Optional. folder to upload the file to, e.g. the file's content
+            hash so that different files with the same name don't overwrite
+            each other
 
     Returns:
         file_url: local file path of the file to upload
@@ -23,12 +38,11 @@ def file_upload(file_url: str,
     """
     print(f'Uploading {file_url} to {upload_bucket}')
 
-    if (credentials != None):
-        client = storage.Client(credentials=credentials)
-    else:
-        client = storage.Client()
+    client = get_storage_client(credentials)
         
     filename = os.path.basename(file_url)
+    if prefix:
+        filename = f"{prefix}/{filename}"
     bucket = client.get_bucket(upload_bucket)
     blob = bucket.blob(filename)
     blob.upload_from_filename(file_url)
@@ -39,8 +53,120 @@ def file_upload(file_url: str,
     
     return file_url, gcs_upload_uri
 
+async def file_upload_async(file_url: str,
+                            upload_bucket: str,
+                            credentials: Optional[Credentials] = None,
+                            prefix: Optional[str] = None):
+    """
+    Async version of file_upload. The storage library has no async client,
+    so the upload runs on a thread on the pooled client (see ClientConfig.pool_size)
+    """
+    return await asyncio.to_thread(file_upload, file_url, upload_bucket, credentials, prefix)
+
+class OutputShard(NamedTuple):
+    """
+    Extracted result of a single docAI output json shard
+    """
+    # cloud storage URI of the shard
+    uri: str
+    # summary text of the shard (summarizer output), or "" if none
+    summary: str
+    # OCR text of the shard
+    text: str
+    # list of {'type', 'mentionText'} of the shard's entities
+    entities: list
+
+def iter_output_shards(gcs_url: str,
+                       credentials: Optional[Credentials] = None,
+                       field_mask: Optional[str] = None):
+    """
+    Generator over the extracted results of a docAI batch operation's
+    output, one OutputShard per json shard in shard order. Only the
+    current shard's parsed json is alive at a time on the caller's side,
+    so results can be streamed without holding the whole output
+
+    Only blobs under the operation's output prefix are listed, and shards
+    are downloaded concurrently (see StorageConfig.download_workers). With
+    StorageConfig.streaming_parse() and a field mask, each shard is parsed
+    as it streams in and only the masked fields are kept
+
+    Args:
+        gcs_url: the url of the output folder of a document parser
+        credentials: Optional. user to run as to get file from storage
+        field_mask: Optional. only parse these fields out of the output json
+
+    Yields:
+        OutputShard
+    """
+    client = get_storage_client(credentials)
+
+    uri = urlparse(gcs_url)
+    bucket = uri.netloc
+    # trailing slash so that output folder "1" doesn't also match "10", "11", ...
+    path = uri.path[1:].rstrip("/")
+    prefix = f"{path}/" if path else None
+
+    blobs = [blob for blob in client.list_blobs(bucket, prefix=prefix)
+             if blob.name.endswith(".json")]
+    blobs.sort(key=lambda blob: _shard_index(blob.name))
+
+    streaming = StorageConfig.streaming_parse() and field_mask
+
+    def download(blob):
+        if streaming:
+            with blob.open("rb", chunk_size=_STREAM_CHUNK_SIZE) as f:
+                blob_obj = docai_json.load_stream(f, field_mask)
+        else:
+            blob_obj = docai_json.loads(blob.download_as_bytes())
+        return _to_output_shard(f"gs://{bucket}/{blob.name}", blob_obj)
+
+    # keep at most `workers` shards in flight and hand them out in order
+    workers = max(1, min(StorageConfig.download_workers(), len(blobs)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for blob in blobs:
+            pending.append(executor.submit(download, blob))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def collect_output(shards: Iterable[OutputShard]):
+    """
+    Collect streamed shards into the final results, joining each string
+    once instead of re-concatenating on every shard
+
+    Args:
+        shards: iterable of OutputShard, e.g. from iter_output_shards
+
+    Returns:
+        json_uri: newline separated URIs of the output shards
+        summary: concatenated summary of the processor results
+        entities: list of key value pair of extracted entities
+        full_text: the full OCR text from the parser
+    """
+    uris = []
+    summaries = []
+    texts = []
+    entities = []
+
+    for shard in shards:
+        uris.append(shard.uri)
+        summaries.append(shard.summary)
+        texts.append(shard.text)
+        entities.extend(shard.entities)
+
+    # each piece keeps the trailing newline the results have always had,
+    # the empty last item adds it without another copy of the joined string
+    json_uri = "\n".join(uris + [""]) if uris else ""
+    summary = "\n".join(summaries + [""]) if summaries else ""
+    full_text = "\n".join(texts + [""]) if texts else ""
+
+    return json_uri, summary, entities, full_text
+
 def extract_from_summary_output(gcs_url: str, 
-                                credentials: Optional[Credentials] = None):
+                                credentials: Optional[Credentials] = None,
+                                field_mask: Optional[str] = None):
     """
     Extract the blob uri, summary, and full extracted text of the 
     summarized result from docAI workbench summarizer
@@ -48,6 +174,7 @@ def extract_from_summary_output(gcs_url: str,
     Args: 
         gcs_url: the url of the output json of a document parser
         credentials: Optional. user to run as to get file from storage
+        field_mask: Optional. only parse these fields out of the output json
 
     Returns:
         json_uri: URI of cloud storage directory of output
@@ -55,36 +182,16 @@ def extract_from_summary_output(gcs_url: str,
         full_text: the full OCR text from the parser
     """
     print(f'Extract docai summary parser output from {gcs_url}')
-    
-    if (credentials != None):
-        client = storage.Client(credentials=credentials)
-    else:
-        client = storage.Client()
-    
-    uri = urlparse(gcs_url)
-    bucket = uri.netloc
-    path = uri.path[1:]    
-    blobs = client.list_blobs(bucket)
-    json_uri = ""
-    summary = ""
-    full_text = ""
-    
-    # output could be multiple json files; loop through them and concat results
-    for blob in blobs:
-        if path in blob.name:
-            content = blob.download_as_string()
-
-            blob_obj = json.loads(content)
-            #print(json.dumps(blob_obj, indent=4, sort_keys=True))
-            
-            json_uri = f'{json_uri}gs://{bucket}/{blob.name}\n'
-            summary = f'{summary}{blob_obj["entities"][0]["normalizedValue"]["text"]}\n'
-            full_text = f'{full_text}{blob_obj["text"]}\n'
-        
+
+    # output could be multiple json files; stream them and join the results once
+    shards = iter_output_shards(gcs_url, credentials, field_mask)
+    json_uri, summary, entities, full_text = collect_output(shards)
+
     return json_uri, summary, full_text
 
 def extract_from_contract_output(gcs_url: str, 
-                                credentials: Optional[Credentials] = None):
+                                credentials: Optional[Credentials] = None,
+                                field_mask: Optional[str] = None):
     """
     Extract the blob uri, list of entities, and full extracted text of the 
     contract parser result from docAI workbench contract parser
@@ -92,44 +199,63 @@ def extract_from_contract_output(gcs_url: str,
     Args: 
         gcs_url: the url of the output json of a document parser
         credentials: Optional. user to run as to get file from storage
+        field_mask: Optional. only parse these fields out of the output json
 
     Returns:
         json_uri: URI of cloud storage directory of output
         entities: list of key value pair of extracted entities
         full_text: the full OCR text from the parser
     """
-    print(f'Extract docai summary parser output from {gcs_url}')
-    
-    if (credentials != None):
-        client = storage.Client(credentials=credentials)
-    else:
-        client = storage.Client()
-    
-    uri = urlparse(gcs_url)
-    bucket = uri.netloc
-    path = uri.path[1:]    
-    blobs = client.list_blobs(bucket)
-    json_uri = ""
-    entities = []
-    full_text = ""
-    
-    # output could be multiple json files; loop through them and concat results
-    for blob in blobs:
-        if path in blob.name:
-            content = blob.download_as_string()
-
-            blob_obj = json.loads(content)
-            #print(json.dumps(blob_obj, indent=4, sort_keys=True))
-            
-            json_uri = f'{json_uri}gs://{bucket}/{blob.name}\n'
-            for entity in blob_obj['entities']:
-                entities.append({'type':entity['type'], 
-                                 'mentionText':entity['mentionText']})
-                
-            full_text = f'{full_text}{blob_obj["text"]}\n'
-        
+    print(f'Extract docai contract parser output from {gcs_url}')
+
+    # output could be multiple json files; stream them and join the results once
+    shards = iter_output_shards(gcs_url, credentials, field_mask)
+    json_uri, summary, entities, full_text = collect_output(shards)
+
     return json_uri, entities, full_text
 
+async def extract_from_summary_output_async(gcs_url: str,
+                                            credentials: Optional[Credentials] = None,
+                                            field_mask: Optional[str] = None):
+    """
+    Async version of extract_from_summary_output; downloads and parsing run on threads
+    """
+    return await asyncio.to_thread(extract_from_summary_output, gcs_url, credentials, field_mask)
+
+async def extract_from_contract_output_async(gcs_url: str,
+                                             credentials: Optional[Credentials] = None,
+                                             field_mask: Optional[str] = None):
+    """
+    Async version of extract_from_contract_output; downloads and parsing run on threads
+    """
+    return await asyncio.to_thread(extract_from_contract_output, gcs_url, credentials, field_mask)
+
+def _shard_index(blob_name: str):
+    """
+    Sort key for docai output shards; shards without an index sort first
+    """
+    match = _SHARD_INDEX.search(blob_name)
+    return int(match.group(1)) if match else -1
+
+def _to_output_shard(uri: str, blob_obj: dict):
+    """
+    Pull the summary, text and entities out of a parsed output json shard
+    """
+    entities = blob_obj.get("entities", [])
+
+    # the summarizer puts the summary in the normalized value of the first entity
+    summary = ""
+    if entities:
+        summary = entities[0].get("normalizedValue", {}).get("text", "")
+
+    return OutputShard(
+        uri=uri,
+        summary=summary,
+        text=blob_obj.get("text", ""),
+        entities=[{'type': entity.get('type', ''),
+                   'mentionText': entity.get('mentionText', '')}
+                  for entity in entities])
+
 def copy_from_to(from_gcs_bucket: str, 
                  from_gcs_path: str, 
                  to_gcs_bucket: str, 
@@ -150,11 +276,8 @@ def copy_from_to(from_gcs_bucket: str,
     """    
     print(f'Copy from {from_gcs_bucket}/{from_gcs_path} to {to_gcs_bucket}/{to_gcs_path}')
     
-    if (credentials != None):
-        client = storage.Client(credentials=credentials)
-    else:
-        client = storage.Client()
-            
+    client = get_storage_client(credentials)
+
     src_bucket = client.bucket(from_gcs_bucket)
     dest_bucket = client.bucket(to_gcs_bucket)
     blobs = src_bucket.list_blobs(prefix=from_gcs_path)
@@ -0,0 +1,143 @@
+import hashlib
+import threading
+import zlib
+from .config import TextStoreConfig
+
+
+class _Entry:
+    def __init__(self, data: bytes, compressed: bool, chars: int):
+        self.data = data
+        self.compressed = compressed
+        self.chars = chars
+        self.refs = 1
+
+
+class TextStore:
+    """
+    Shared store of large texts (e.g. the OCR text of a document), kept once
+    however many sessions hold them. Texts are keyed by their content hash,
+    so uploading the same document in several sessions stores it once; large
+    texts are kept zlib compressed (see TextStoreConfig). Entries are
+    reference counted and dropped as soon as the last holder releases them
+
+    Args:
+        compress_min_chars: compress texts with at least this many characters; 0 never
+        compress_level: zlib compression level
+        loader: Optional. called with a handle that is not stored here, returning
+            its text or None; e.g. to fetch texts other processes stored in a
+            shared session store (see gcp_functions.session_store)
+    """
+    def __init__(self, compress_min_chars: int = 0, compress_level: int = 1, loader=None):
+        self.compress_min_chars = compress_min_chars
+        self.compress_level = compress_level
+        self.loader = loader
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def put(self, text: str):
+        """
+        Store text, or take another reference to it if already stored
+
+        Returns:
+            handle to get and release the text with; None for empty text
+        """
+        if not text:
+            return None
+
+        encoded = text.encode("utf-8")
+        handle = hashlib.sha256(encoded).hexdigest()
+
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is not None:
+                entry.refs += 1
+                return handle
+
+        self._insert(handle, text, encoded)
+        return handle
+
+    def _insert(self, handle: str, text: str, encoded: bytes):
+        compressed = 0 < self.compress_min_chars <= len(text)
+        data = zlib.compress(encoded, self.compress_level) if compressed else encoded
+
+        with self._lock:
+            # another thread may have stored it while we were compressing
+            entry = self._entries.get(handle)
+            if entry is not None:
+                entry.refs += 1
+            else:
+                self._entries[handle] = _Entry(data, compressed, len(text))
+
+    def acquire(self, handle: str | None):
+        """
+        Take another reference to a stored text (e.g. for a copy of its
+        holder). A text that is not stored here is fetched with the loader
+        """
+        if handle is None:
+            return
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is not None:
+                entry.refs += 1
+                return
+
+        text = self.loader(handle) if self.loader is not None else None
+        if text:
+            self._insert(handle, text, text.encode("utf-8"))
+
+    def get(self, handle: str | None):
+        """
+        The text for a handle; empty if the handle is None or the text is
+        not stored (here, or with the loader)
+        """
+        if handle is None:
+            return ""
+        entry = self._entries.get(handle)
+        if entry is None:
+            text = self.loader(handle) if self.loader is not None else None
+            return text or ""
+        data = zlib.decompress(entry.data) if entry.compressed else entry.data
+        return data.decode("utf-8")
+
+    def release(self, handle: str | None):
+        """
+        Drop a reference to a stored text, removing it with its last reference
+        """
+        if handle is None:
+            return
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs <= 0:
+                del self._entries[handle]
+
+    def stats(self):
+        """
+        Number of texts stored, references to them, and their size as stored and in characters
+        """
+        with self._lock:
+            entries = list(self._entries.values())
+        return {"texts": len(entries),
+                "refs": sum(e.refs for e in entries),
+                "stored_bytes": sum(len(e.data) for e in entries),
+                "chars": sum(e.chars for e in entries)}
+
+
+_text_store = None
+_text_store_lock = threading.Lock()
+
+
+def get_text_store():
+    """
+    Process-wide TextStore
+    """
+    global _text_store
+
+    with _text_store_lock:
+        if _text_store is None:
+            compress_min_chars = TextStoreConfig.compress_min_chars() if TextStoreConfig.compress() else 0
+            _text_store = TextStore(compress_min_chars, TextStoreConfig.compress_level())
+
+    return _text_store
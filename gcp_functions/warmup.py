@@ -0,0 +1,96 @@
+import threading
+import time
+from . import clients
+from . import gemini
+from .cache import get_document_cache, get_answer_cache
+from .config import (ProjectConfig, SummaryParserConfig, ContractParserConfig,
+                     DiscoveryEngineConfig, GeminiConfig, WarmupConfig)
+from .credentials import get_service_account_credentials
+from .discoveryengine import _search_specs
+
+
+def _contract_clients():
+    key_file = ContractParserConfig.service_account_key()
+    credentials = get_service_account_credentials(key_file) if key_file else None
+    clients.get_docai_client(ContractParserConfig.location(), credentials)
+    clients.get_storage_client(credentials)
+
+
+def _search_client():
+    if DiscoveryEngineConfig.engine_id():
+        clients.get_search_client(DiscoveryEngineConfig.location())
+        _search_specs()
+
+
+# (name, step) in the order they run; the sdk imports come first since
+# everything after needs them
+_STEPS = [
+    ("storage sdk", clients.storage.load),
+    ("docai sdk", clients.docai.load),
+    ("search sdk", clients.discoveryengine.load),
+    ("gemini sdk", lambda: (clients.generative_models.load(), gemini.initializer.load())),
+    ("project id", ProjectConfig.get_project_id),
+    ("caches", lambda: (get_document_cache(), get_answer_cache())),
+    ("storage client", clients.get_storage_client),
+    ("summary parser client", lambda: clients.get_docai_client(SummaryParserConfig.location())),
+    ("contract parser clients", _contract_clients),
+    ("search client", _search_client),
+    ("gemini model", lambda: (clients.get_generative_model(GeminiConfig.model()), gemini._quota_scope())),
+]
+
+# steps for an app that only uploads to storage and calls gemini (e.g. audio_example)
+STORAGE_GEMINI_STEPS = ("storage sdk", "gemini sdk", "storage client", "gemini model")
+
+
+def warm_up(steps: tuple | None = None):
+    """
+    Do the slow parts of the first request ahead of time: import the GCP
+    sdks, look up the project id, load credentials and create the shared
+    clients. A step that fails is skipped; the first request that needs it
+    will do it (and report the error) instead
+
+    Args:
+        steps: Optional. names of the steps to run (see _STEPS), for apps that
+            only use some of the services; defaults to all of them
+
+    Returns:
+        seconds taken by each step
+    """
+    if steps is not None:
+        unknown = set(steps) - {name for name, step in _STEPS}
+        if unknown:
+            raise ValueError(f"Unknown warm-up steps: {', '.join(sorted(unknown))}")
+
+    timings = {}
+    for name, step in _STEPS:
+        if steps is not None and name not in steps:
+            continue
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            print(f"Warm-up: {name} failed: {e}")
+        timings[name] = time.perf_counter() - start
+
+    print("Warm-up done: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    return timings
+
+
+def start_warm_up(steps: tuple | None = None):
+    """
+    Run warm_up() on a background thread, unless disabled (see
+    WarmupConfig). Call it once the server is accepting requests so that
+    start up isn't held up by it
+
+    Args:
+        steps: Optional. names of the steps to run; defaults to all of them
+
+    Returns:
+        the thread, or None if warm-up is disabled
+    """
+    if not WarmupConfig.enabled():
+        return None
+
+    thread = threading.Thread(target=warm_up, args=(steps,), name="warm-up", daemon=True)
+    thread.start()
+    return thread
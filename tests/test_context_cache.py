@@ -0,0 +1,102 @@
+import os
+import time
+import pytest
+from gcp_functions.config import reload_settings
+from gcp_functions.context_cache import ContextCacheManager, MemoryCacheBackend
+
+MODEL = "gemini-1.5-flash-002"
+# long enough to qualify with CONTEXT_CACHE_MIN_TOKENS=10
+TEXT = "a document long enough to be worth caching " * 10
+TEXT_HASH = ContextCacheManager()._key(TEXT, MODEL)[0]
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setenv("CONTEXT_CACHE_ENABLED", "true")
+    monkeypatch.setenv("CONTEXT_CACHE_MIN_TOKENS", "10")
+    monkeypatch.setenv("CONTEXT_CACHE_TTL_SECONDS", "100")
+    monkeypatch.setenv("CONTEXT_CACHE_MODELS", MODEL)
+    reload_settings()
+    yield
+    monkeypatch.undo()
+    reload_settings()
+
+
+def test_create_and_reuse():
+    backend = MemoryCacheBackend()
+    manager = ContextCacheManager(backend)
+
+    model = manager.get_model(TEXT, MODEL)
+    assert model is not None
+    assert manager.get_model(TEXT, MODEL) is model
+    assert backend.created == 1
+    assert list(backend.contexts.values())[0]["text"] == TEXT
+
+
+def test_not_qualifying():
+    backend = MemoryCacheBackend()
+    manager = ContextCacheManager(backend)
+
+    assert manager.get_model("short", MODEL) is None
+    assert manager.get_model(TEXT, "another-model") is None
+    assert backend.created == 0
+
+
+def test_ttl_extended_while_used():
+    backend = MemoryCacheBackend()
+    manager = ContextCacheManager(backend)
+    manager.get_model(TEXT, MODEL)
+
+    # not extended while most of the ttl is left
+    manager.get_model(TEXT, MODEL)
+    assert backend.extended == 0
+
+    entry = manager._entries[(TEXT_HASH, MODEL)]
+    entry.expires = time.time() + 10
+    manager.get_model(TEXT, MODEL)
+    assert backend.extended == 1
+    assert entry.expires > time.time() + 90
+
+
+def test_expired_entry_recreated():
+    backend = MemoryCacheBackend()
+    manager = ContextCacheManager(backend)
+    manager.get_model(TEXT, MODEL)
+
+    manager._entries[(TEXT_HASH, MODEL)].expires = time.time() - 1
+    manager.get_model(TEXT, MODEL)
+    assert backend.created == 2
+
+
+def test_release_deletes_with_last_session():
+    backend = MemoryCacheBackend()
+    manager = ContextCacheManager(backend)
+    manager.acquire(TEXT_HASH, MODEL)
+    manager.acquire(TEXT_HASH, MODEL)
+    manager.get_model(TEXT, MODEL)
+
+    manager.release(TEXT_HASH, MODEL)
+    assert backend.deleted == 0
+    manager.release(TEXT_HASH, MODEL)
+    assert backend.deleted == 1
+    assert backend.contexts == {}
+
+
+def test_failure_is_remembered():
+    backend = MemoryCacheBackend(fail=True)
+    manager = ContextCacheManager(backend)
+
+    assert manager.get_model(TEXT, MODEL) is None
+    backend.fail = False
+    assert manager.get_model(TEXT, MODEL) is None
+    assert backend.created == 0
+
+
+def test_cleanup_deletes_everything():
+    backend = MemoryCacheBackend()
+    manager = ContextCacheManager(backend)
+    manager.get_model(TEXT, MODEL)
+    manager.get_model(TEXT + "more", MODEL)
+
+    manager.cleanup()
+    assert backend.contexts == {}